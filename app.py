@@ -494,7 +494,7 @@ def obd2_results(session_id):
     if dtcs:
         try:
             # Import the AI module
-            from utils.diagnostic_ai import DiagnosticAI
+            from utils.diagnostic_ai import get_diagnostic_ai
             
             # Convert DTCs to format expected by AI
             dtc_list = [{'code': dtc.code, 'description': dtc.description, 'type': dtc.type} for dtc in dtcs]
@@ -510,8 +510,8 @@ def obd2_results(session_id):
                     'vin': vehicle.vin if vehicle.vin else None
                 }
                 
-                # Create AI instance and analyze
-                ai = DiagnosticAI(use_openai=False, use_anthropic=True)
+                # Get the shared AI instance and analyze
+                ai = get_diagnostic_ai(use_openai=False, use_anthropic=True)
                 results = ai.analyze_dtcs(dtc_list, vehicle_info)
         except Exception as e:
             app.logger.error(f"Error analyzing DTCs: {str(e)}")
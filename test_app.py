@@ -12,6 +12,7 @@ import tempfile
 from unittest.mock import Mock, patch
 from flask import Flask
 import json
+import logging
 
 # Add the project root to Python path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -27,8 +28,9 @@ from utils.dtc_database import initialize_dtc_database
 class TestOBD2DiagnosticPro:
     """Comprehensive test suite for OBD2 Diagnostic Pro."""
     
-    @pytest.fixture
-    def app(self):
+    @pytest.fixture(scope="class")
+    @staticmethod
+    def app():
         """Create test app with temporary database."""
         # Create temporary database
         db_fd, db_path = tempfile.mkstemp()
@@ -53,15 +55,44 @@ class TestOBD2DiagnosticPro:
         os.close(db_fd)
         os.unlink(db_path)
     
+    @pytest.fixture(scope="class")
+    @staticmethod
+    def client(app):
+        """Create test client shared by the tests in this class."""
+        return app.test_client()
+    
     @pytest.fixture
-    def client(self, app):
-        """Create test client."""
+    def client_fresh(self, app):
+        """Create test client with a clean cookie jar."""
         return app.test_client()
     
+    @pytest.fixture(scope="class")
+    @staticmethod
+    def dtc_lookup(app):
+        """Look up the reference DTCs used by the tests once per class."""
+        from utils.dtc_database import get_dtc_info, search_dtcs
+        
+        with app.app_context():
+            return {'p0301': get_dtc_info('P0301'), 'misfire': search_dtcs('misfire')}
+    
     @pytest.fixture
     def runner(self, app):
         """Create test runner."""
         return app.test_cli_runner()
+    
+    @pytest.fixture
+    def ai(self):
+        """Create a DiagnosticAI that calls OpenAI, resetting the shared AI state afterwards."""
+        from utils.diagnostic_ai import _breakers, _response_cache
+        _response_cache.clear()
+        
+        ai = DiagnosticAI(use_openai=False, use_anthropic=False)
+        ai.use_openai = True
+        yield ai
+        
+        _response_cache.clear()
+        for breaker in _breakers.values():
+            breaker.record_success()
 
     def test_app_creation(self, app):
         """Test app creation and configuration."""
@@ -87,10 +118,10 @@ class TestOBD2DiagnosticPro:
         assert response.status_code == 200
         assert b'Connect Your Vehicle' in response.data or b'Vehicle Information' in response.data
 
-    def test_obd2_connect_post(self, client, app):
+    def test_obd2_connect_post(self, client_fresh, app):
         """Test OBD2 connect page POST request."""
         with app.app_context():
-            response = client.post('/obd2/connect', data={
+            response = client_fresh.post('/obd2/connect', data={
                 'make': 'Toyota',
                 'model': 'Camry',
                 'year': '2020',
@@ -103,10 +134,10 @@ class TestOBD2DiagnosticPro:
             assert vehicle is not None
             assert vehicle.year == 2020
 
-    def test_vehicle_info_processing(self, client, app):
+    def test_vehicle_info_processing(self, client_fresh, app):
         """Test vehicle information processing."""
         with app.app_context():
-            response = client.post('/vehicle-info', data={
+            response = client_fresh.post('/vehicle-info', data={
                 'make': 'Honda',
                 'model': 'Civic',
                 'year': '2019',
@@ -169,18 +200,18 @@ class TestOBD2DiagnosticPro:
                 assert 'value' in live_data[sensor]
                 assert 'unit' in live_data[sensor]
 
-    def test_live_data_api(self, client, app):
+    def test_live_data_api(self, client_fresh, app):
         """Test live data API endpoint."""
         with app.app_context():
             # First create a vehicle and session
-            client.post('/vehicle-info', data={
+            client_fresh.post('/vehicle-info', data={
                 'make': 'Test',
                 'model': 'Vehicle', 
                 'year': '2020',
                 'mileage': '1000'
             })
             
-            response = client.get('/api/obd2/live-data')
+            response = client_fresh.get('/api/obd2/live-data')
             assert response.status_code in [200, 400]  # 400 if no vehicle selected
             
             if response.status_code == 200:
@@ -198,18 +229,18 @@ class TestOBD2DiagnosticPro:
             assert 'ports' in data
             assert isinstance(data['ports'], list)
 
-    def test_clear_dtcs_api(self, client, app):
+    def test_clear_dtcs_api(self, client_fresh, app):
         """Test clear DTCs API endpoint."""
         with app.app_context():
             # Create a test session
-            client.post('/vehicle-info', data={
+            client_fresh.post('/vehicle-info', data={
                 'make': 'Test',
                 'model': 'Vehicle',
                 'year': '2020', 
                 'mileage': '1000'
             })
             
-            response = client.post('/api/obd2/clear-dtcs')
+            response = client_fresh.post('/api/obd2/clear-dtcs')
             # Should return 400 if no vehicle selected, or 200/500 based on operation
             assert response.status_code in [200, 400, 500]
 
@@ -224,6 +255,458 @@ class TestOBD2DiagnosticPro:
             ai_real = DiagnosticAI()
             assert ai_real is not None
 
+    def test_diagnostic_ai_shared_instance(self):
+        """Test that the shared DiagnosticAI is reused for the same providers."""
+        from utils.diagnostic_ai import get_diagnostic_ai
+
+        ai = get_diagnostic_ai(use_openai=False, use_anthropic=False)
+        assert get_diagnostic_ai(use_openai=False, use_anthropic=False) is ai
+        assert get_diagnostic_ai(use_openai=True, use_anthropic=False) is not ai
+
+    def test_diagnostic_ai_response_cache(self, ai):
+        """Test that repeated AI requests are served from the response cache."""
+        guide = {'repair_name': 'Replace spark plugs', 'steps': ['Step 1']}
+        vehicle_info = {'make': 'Honda', 'model': 'Civic', 'year': 2015, 'mileage': 81000}
+
+        with patch.object(ai, '_repair_guide_with_openai', return_value=guide) as mock_call:
+            first = ai.generate_repair_guide('Cylinder 1 misfire', vehicle_info)
+            second = ai.generate_repair_guide('cylinder 1 misfire ', dict(vehicle_info, mileage=84000))
+
+        assert first == guide
+        assert second == guide
+        assert mock_call.call_count == 1
+
+    def test_output_token_limit_scales_with_codes(self, ai):
+        """Test that the AI output token limit is sized to the number of DTCs."""
+        from utils.diagnostic_ai import MAX_OUTPUT_TOKENS
+
+        dtc = {'code': 'P0171', 'description': 'System Too Lean Bank 1', 'type': 'stored'}
+
+        with patch.object(ai, '_analyze_with_openai', return_value={'severity': 'low'}) as mock_call:
+            ai.analyze_dtcs([dtc], {'make': 'Honda'})
+            ai.analyze_dtcs([dtc] * 20, {'make': 'Ford'})
+
+        single, many = (call[0][2] for call in mock_call.call_args_list)
+        assert single < many == MAX_OUTPUT_TOKENS
+
+    def test_sensor_cache_keyed_on_exact_readings(self, ai):
+        """Test that a sensor reading crossing an anomaly threshold is not served from the cache."""
+        vehicle = {'make': 'Honda', 'model': 'Civic'}
+
+        def readings(o2_voltage):
+            return {'O2_B1S1': {'value': o2_voltage, 'unit': 'V'}}
+
+        with patch.object(ai, '_analyze_with_openai', return_value={'summary': 'Normal'}) as mock_call:
+            ai.analyze_sensor_data(readings(0.3), vehicle)
+            ai.analyze_sensor_data(readings(0.3), vehicle)
+            assert mock_call.call_count == 1
+
+            ai.analyze_sensor_data(readings(0.05), vehicle)
+            assert mock_call.call_count == 2
+
+    def test_diagnostic_ai_dtc_batch(self, ai):
+        """Test that several DTC analyses are sent in a single AI request."""
+        from utils.diagnostic_ai import BATCH_TOKENS_PER_CASE
+
+        items = [
+            ([{'code': 'P0301', 'description': 'Cylinder 1 Misfire', 'type': 'stored'}], {'make': 'Honda'}),
+            ([{'code': 'P0171', 'description': 'System Too Lean Bank 1', 'type': 'stored'}], {'make': 'Ford'})
+        ]
+        batch = {'results': [{'severity': 'critical'}, {'severity': 'high'}]}
+
+        with patch.object(ai, '_analyze_with_openai', return_value=batch) as mock_call:
+            results = ai.analyze_dtcs_batch(items)
+
+        assert [result['severity'] for result in results] == ['critical', 'high']
+        assert mock_call.call_count == 1
+        assert '### Case 2' in mock_call.call_args[0][0]
+        assert mock_call.call_args[0][2] >= 2 * BATCH_TOKENS_PER_CASE
+
+    def test_diagnostic_ai_dtc_batch_split_into_groups(self, ai):
+        """Test that a large DTC batch is sent as several concurrent AI requests."""
+        items = [([{'code': f'P030{cylinder}', 'description': 'Misfire', 'type': 'stored'}], {'make': 'Honda'})
+                 for cylinder in range(1, 6)]
+
+        def analyze(prompt, *args):
+            cases = prompt.count('### Case')
+            return {'results': [{'severity': 'low'}] * cases}
+
+        with patch.object(ai, '_analyze_with_openai', side_effect=analyze) as mock_call:
+            results = ai.analyze_dtcs_batch(items, batch_size=2)
+
+        assert mock_call.call_count == 3
+        assert [result['severity'] for result in results] == ['low'] * 5
+
+    def test_diagnostic_ai_dtc_batch_job(self, ai):
+        """Test queuing DTC analyses on the Message Batches API and collecting them."""
+        ai.anthropic_client = Mock()
+        batches = ai.anthropic_client.messages.batches
+        batches.create.return_value = Mock(id='batch_1')
+        items = [
+            ([{'code': 'P0301', 'description': 'Cylinder 1 Misfire', 'type': 'stored'}], {'make': 'Honda'}),
+            ([{'code': 'P0420', 'description': 'Catalyst Efficiency', 'type': 'stored'}], {'make': 'Ford'})
+        ]
+
+        assert ai.submit_dtc_batch_job(items) == 'batch_1'
+        requests = batches.create.call_args.kwargs['requests']
+        assert [request['custom_id'] for request in requests] == ['case-0', 'case-1']
+        assert 'P0420' in requests[1]['params']['messages'][0]['content']
+
+        batches.retrieve.return_value = Mock(processing_status='in_progress')
+        assert ai.collect_dtc_batch_job('batch_1', items) is None
+
+        block = Mock(type='tool_use', input={'severity': 'low'})
+        succeeded = Mock(custom_id='case-0')
+        succeeded.result.type = 'succeeded'
+        succeeded.result.message.content = [block]
+        errored = Mock(custom_id='case-1')
+        errored.result.type = 'errored'
+        batches.retrieve.return_value = Mock(processing_status='ended')
+        batches.results.return_value = [succeeded, errored]
+
+        results = ai.collect_dtc_batch_job('batch_1', items)
+        assert results[0]['severity'] == 'low'
+        assert results[1]['severity'] == 'high'
+        assert ai.analyze_dtcs(*items[0]) == results[0]
+
+    def test_ai_response_normalized(self, ai):
+        """Test that AI responses are validated and missing fields get defaults."""
+        dtcs = [{'code': 'P0171', 'description': 'System Too Lean Bank 1', 'type': 'stored'}]
+
+        response = {'severity': ' High', 'diagnoses': 'not a list', 'summary': 'Lean condition'}
+        with patch.object(ai, '_analyze_with_openai', return_value=response):
+            result = ai.analyze_dtcs(dtcs, {'make': 'Honda'})
+
+        assert result['severity'] == 'high'
+        assert result['diagnoses'] == [] and result['safety_warnings'] == []
+        assert result['summary'] == 'Lean condition'
+
+        with patch.object(ai, '_analyze_with_openai', return_value=['not', 'an', 'object']):
+            result = ai.analyze_dtcs(dtcs, {'make': 'Ford'})
+        assert result['diagnoses'][0]['name'] == 'P0171'
+
+    def test_dtc_analysis_submitted_in_background(self, ai):
+        """Test that a DTC analysis can be started in the background and collected later."""
+        ai.use_openai = False
+        dtcs = [{'code': 'P0420', 'description': 'Catalyst Efficiency', 'type': 'stored'}]
+
+        future = ai.submit_dtc_analysis(dtcs, {'make': 'Toyota'})
+        result = future.result(timeout=5)
+
+        assert result['diagnoses'][0]['name'] == 'P0420'
+
+    def test_identical_requests_in_flight_share_one_call(self, ai):
+        """Test that concurrent identical DTC analyses make a single AI call."""
+        import threading
+        from concurrent.futures import Future
+        dtcs = [{'code': 'P0300', 'description': 'Random Misfire', 'type': 'stored'}]
+        started = threading.Event()
+        waiting = threading.Event()
+        release = threading.Event()
+
+        class WatchedFuture(Future):
+            def result(self, timeout=None):
+                waiting.set()
+                return super().result(timeout)
+
+        def slow_call(*args):
+            started.set()
+            release.wait(5)
+            return {'severity': 'high'}
+
+        results = []
+        with patch.object(ai, '_analyze_with_openai', side_effect=slow_call) as mock_call, \
+                patch('utils.diagnostic_ai.Future', WatchedFuture):
+            threads = [threading.Thread(target=lambda: results.append(ai.analyze_dtcs(dtcs, {'make': 'Honda'})))
+                       for _ in range(2)]
+            threads[0].start()
+            started.wait(5)
+            threads[1].start()
+            # Only release the first call once the second is waiting on its result
+            assert waiting.wait(5)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+
+        assert mock_call.call_count == 1
+        assert results[0] == results[1] and results[0] is not results[1]
+
+    def test_response_cached_before_leaving_flight(self, ai):
+        """Test that a response is cached while its request is still in flight."""
+        from utils.diagnostic_ai import _inflight, _response_cache
+        dtcs = [{'code': 'P0420', 'description': 'Catalyst Efficiency', 'type': 'stored'}]
+        in_flight_when_cached = []
+        cache_set = _response_cache.set
+
+        def record_set(key, value):
+            in_flight_when_cached.append(key in _inflight)
+            cache_set(key, value)
+
+        with patch.object(ai, '_analyze_with_openai', return_value={'severity': 'low'}), \
+                patch.object(_response_cache, 'set', side_effect=record_set):
+            ai.analyze_dtcs(dtcs, {'make': 'Toyota'})
+
+        assert in_flight_when_cached == [True]
+
+    def test_openai_uses_structured_outputs(self, ai):
+        """Test that OpenAI requests enforce the response JSON Schema."""
+        ai.openai_client = Mock()
+        chunk = Mock()
+        chunk.choices = [Mock()]
+        chunk.choices[0].delta.content = '{"severity": "low"}'
+        ai.openai_client.chat.completions.create.return_value.__enter__ = Mock(return_value=iter([chunk]))
+        ai.openai_client.chat.completions.create.return_value.__exit__ = Mock(return_value=False)
+
+        result = ai.analyze_dtcs([{'code': 'P0420', 'description': 'Catalyst', 'type': 'stored'}], {'make': 'Kia'})
+
+        response_format = ai.openai_client.chat.completions.create.call_args.kwargs['response_format']
+        schema = response_format['json_schema']['schema']
+        assert response_format['type'] == 'json_schema' and response_format['json_schema']['strict']
+        assert set(schema['required']) == set(schema['properties']) and not schema['additionalProperties']
+        assert ai.openai_client.chat.completions.create.call_args.kwargs['temperature'] == 0
+        assert result['severity'] == 'low'
+
+    def test_anthropic_uses_forced_tool_call(self, ai):
+        """Test that Anthropic requests stream the input of a tool with the response JSON Schema."""
+        ai.use_openai = False
+        ai.use_anthropic = True
+        ai.anthropic_client = Mock()
+        events = [Mock(type='input_json', partial_json='{"severity": '), Mock(type='input_json', partial_json='"low"}')]
+        ai.anthropic_client.messages.stream.return_value.__enter__ = Mock(return_value=iter(events))
+        ai.anthropic_client.messages.stream.return_value.__exit__ = Mock(return_value=False)
+
+        result = ai.analyze_dtcs([{'code': 'P0420', 'description': 'Catalyst', 'type': 'stored'}], {'make': 'Kia'})
+
+        request = ai.anthropic_client.messages.stream.call_args.kwargs
+        assert request['tool_choice'] == {'type': 'tool', 'name': request['tools'][0]['name']}
+        assert 'severity' in request['tools'][0]['input_schema']['properties']
+        assert result['severity'] == 'low'
+
+    def test_anthropic_usage_logged(self, caplog):
+        """Test that Anthropic token usage is logged from the stream events."""
+        ai = DiagnosticAI(use_openai=False, use_anthropic=False)
+        ai.anthropic_client = Mock()
+        start = Mock(type='message_start')
+        start.message.usage = Mock(input_tokens=900, cache_read_input_tokens=0, cache_creation_input_tokens=0)
+        delta = Mock(type='message_delta', usage=Mock(output_tokens=350), delta=Mock(stop_reason='end_turn'))
+        events = [start, Mock(type='text', text='{}'), delta]
+        ai.anthropic_client.messages.stream.return_value.__enter__ = Mock(return_value=iter(events))
+        ai.anthropic_client.messages.stream.return_value.__exit__ = Mock(return_value=False)
+
+        with caplog.at_level(logging.INFO, logger='utils.diagnostic_ai'):
+            assert list(ai._stream_anthropic_text('prompt')) == ['{}']
+
+        assert '900 uncached input tokens, 0 read from and 0 written to the prompt cache' in caplog.text
+        assert '350 output tokens, stop reason end_turn' in caplog.text
+
+    def test_circuit_breaker_skips_failing_provider(self, ai):
+        """Test that a provider is skipped after repeated failures."""
+        dtcs = [{'code': 'P0301', 'description': 'Cylinder 1 Misfire', 'type': 'stored'}]
+
+        with patch.object(ai, '_analyze_with_openai', return_value=None) as mock_call:
+            for _ in range(4):
+                result = ai.analyze_dtcs(dtcs, {'make': 'Honda'})
+
+        assert mock_call.call_count == 3
+        assert result['severity'] == 'high'
+
+    def test_circuit_breaker_logs_transitions_once(self, caplog):
+        """Test that a breaker logs opening and closing once, not on every failure."""
+        from utils.diagnostic_ai import CircuitBreaker
+
+        breaker = CircuitBreaker('Test', failure_threshold=2)
+        with caplog.at_level(logging.WARNING, logger='utils.diagnostic_ai'):
+            for _ in range(5):
+                breaker.record_failure()
+            breaker.record_success()
+            breaker.record_success()
+
+        messages = [record.getMessage() for record in caplog.records]
+        assert len(messages) == 2
+        assert 'opened' in messages[0] and 'closed' in messages[1]
+
+    def test_circuit_breaker_lets_one_probe_through(self):
+        """Test that a breaker lets a single call through once the reset timeout has passed."""
+        from utils.diagnostic_ai import CircuitBreaker
+
+        breaker = CircuitBreaker('Test', failure_threshold=1, reset_timeout=30.0)
+        with patch('utils.diagnostic_ai.time.monotonic', return_value=100.0):
+            breaker.record_failure()
+            assert not breaker.allow()
+
+        with patch('utils.diagnostic_ai.time.monotonic', return_value=131.0):
+            assert breaker.allow()
+            assert not breaker.allow()
+            breaker.record_success()
+            assert breaker.allow() and breaker.allow()
+
+    def test_transient_provider_errors_retried(self):
+        """Test that transient provider errors are retried before giving up."""
+        from utils.diagnostic_ai import _retryable_errors, _with_retries
+
+        call = Mock(side_effect=[TimeoutError(), TimeoutError(), '{"severity": "low"}'])
+        with patch.dict(_retryable_errors, {'OpenAI': (TimeoutError,)}), patch('utils.diagnostic_ai.time.sleep'):
+            assert _with_retries('OpenAI', call) == '{"severity": "low"}'
+            assert call.call_count == 3
+
+            with pytest.raises(ValueError):
+                _with_retries('OpenAI', Mock(side_effect=ValueError()))
+
+    def test_rate_limit_retry_waits_for_retry_after(self):
+        """Test that a rate limited request is not retried before the provider's Retry-After."""
+        from utils.diagnostic_ai import _retryable_errors, _with_retries
+
+        class RateLimited(Exception):
+            def __init__(self, retry_after):
+                self.response = Mock(headers={'retry-after': retry_after})
+
+        call = Mock(side_effect=[RateLimited('2'), '{"severity": "low"}'])
+        with patch.dict(_retryable_errors, {'OpenAI': (RateLimited,)}), \
+                patch('utils.diagnostic_ai.time.sleep') as mock_sleep:
+            assert _with_retries('OpenAI', call) == '{"severity": "low"}'
+            assert mock_sleep.call_args[0][0] >= 2
+
+            with pytest.raises(RateLimited):
+                _with_retries('OpenAI', Mock(side_effect=RateLimited('60')))
+            assert mock_sleep.call_count == 1
+
+    def test_cancelled_provider_call_not_retried(self):
+        """Test that a provider call is not retried once another provider has answered."""
+        import threading
+        from utils.diagnostic_ai import _CallCancelled, _call_state, _retryable_errors, _with_retries
+
+        cancelled = threading.Event()
+
+        def fail_and_lose(*args):
+            cancelled.set()
+            raise TimeoutError()
+
+        call = Mock(side_effect=fail_and_lose)
+        _call_state.cancelled = cancelled
+        try:
+            with patch.dict(_retryable_errors, {'OpenAI': (TimeoutError,)}):
+                with pytest.raises(_CallCancelled):
+                    _with_retries('OpenAI', call)
+        finally:
+            _call_state.cancelled = None
+
+        assert call.call_count == 1
+
+    def test_losing_provider_stream_cancelled(self):
+        """Test that a provider stream stops once another provider has answered."""
+        import threading
+        from utils.diagnostic_ai import _CallCancelled, _call_state, _collect_stream
+
+        cancelled = threading.Event()
+        closed = []
+
+        def chunks():
+            try:
+                yield '{"severity":'
+                cancelled.set()
+                yield ' "low"}'
+                yield ', "summary": "never read"}'
+            finally:
+                closed.append(True)
+
+        _call_state.cancelled = cancelled
+        try:
+            with pytest.raises(_CallCancelled):
+                _collect_stream(chunks())
+        finally:
+            _call_state.cancelled = None
+
+        assert closed
+        assert _collect_stream(chunk for chunk in ['{"a": ', '1}']) == '{"a": 1}'
+
+    def test_stream_stops_when_json_complete(self):
+        """Test that a streamed response is no longer read once its JSON object has closed."""
+        from utils.diagnostic_ai import _collect_stream
+
+        read_past_json = []
+
+        def chunks():
+            yield 'Here is the analysis: {"summary": "brace } in text",'
+            yield ' "severity": "low"} Let me know'
+            read_past_json.append(True)
+            yield ' if you have any questions.'
+
+        assert _collect_stream(chunks()) == 'Here is the analysis: {"summary": "brace } in text", "severity": "low"}'
+        assert not read_past_json
+
+    def test_extract_json_from_ai_response(self):
+        """Test extracting the JSON object from an AI response with extra text."""
+        from utils.diagnostic_ai import _extract_json
+
+        response_text = 'Here is the analysis:\n```json\n{"text": "brace } in \\"string\\"", "nested": {"a": 1}}\n```\nDone {}'
+        assert json.loads(_extract_json(response_text)) == {'text': 'brace } in "string"', 'nested': {'a': 1}}
+        assert _extract_json('No JSON here') is None
+        assert _extract_json('{"truncated": [1, 2') is None
+
+    def test_vehicle_info_normalization(self):
+        """Test that vehicle dictionaries are normalized into VehicleInfo."""
+        from utils.diagnostic_ai import VehicleInfo
+
+        vehicle = VehicleInfo.from_dict({'year': 2015, 'make': 'Honda', 'mileage': 85000})
+        assert vehicle == VehicleInfo(year=2015, make='Honda', mileage=85000)
+        assert vehicle.model == 'Unknown'
+        assert VehicleInfo.from_dict(vehicle) is vehicle
+
+        prompt = DiagnosticAI(use_openai=False, use_anthropic=False)._generate_dtc_analysis_prompt([], vehicle)
+        assert '- Make: Honda' in prompt
+        assert '- VIN: Unknown' in prompt
+
+    def test_diagnostic_session_reuses_vehicle(self, ai):
+        """Test that a diagnostic session reuses its pre-rendered vehicle block."""
+        session = ai.get_session({'year': 2018, 'make': 'Toyota', 'model': 'Camry'})
+
+        with patch.object(ai, '_analyze_with_openai', return_value={'severity': 'low'}) as mock_call:
+            assert session.analyze_dtcs([{'code': 'P0420', 'type': 'stored'}])['severity'] == 'low'
+
+        assert mock_call.call_args[0][0].startswith(session.vehicle.prompt_block)
+        assert '- Model: Camry' in session.vehicle.prompt_block
+
+    def test_diagnostic_ai_dtc_stream(self, ai):
+        """Test that the streamed severity and diagnoses are yielded before the full analysis."""
+        chunks = ['{"severity": " Hi', 'gh", "diagnoses": [{"name": "Mis', 'fire", "severity": "low"}, {"name": "Lean"}]',
+                  ', "diy_repairs": []}']
+        dtcs = [{'code': 'P0301', 'description': 'Cylinder 1 Misfire', 'type': 'stored'}]
+
+        with patch.object(ai, '_stream_openai_text', return_value=(chunk for chunk in chunks)):
+            events = list(ai.analyze_dtcs_stream(dtcs, {'make': 'Honda'}))
+
+        assert events[0] == ('severity', 'high')
+        assert events[1] == ('diagnosis', {'name': 'Misfire', 'severity': 'low'})
+        assert events[2] == ('diagnosis', {'name': 'Lean'})
+        assert events[3][0] == 'analysis'
+        assert events[3][1]['severity'] == 'high'
+
+    def test_diagnostic_ai_dtc_stream_falls_back_to_other_provider(self, ai):
+        """Test that a failed stream resets its partial results and the other provider is tried."""
+        import threading
+        from utils.diagnostic_ai import _provider_slots
+        ai.use_anthropic = True
+        slot = threading.BoundedSemaphore(1)
+        dtcs = [{'code': 'P0301', 'description': 'Cylinder 1 Misfire', 'type': 'stored'}]
+
+        def failing_stream(*args, **kwargs):
+            yield '{"severity": "low", "diagnoses": [{"name": "Coil"}'
+            raise TimeoutError()
+
+        openai_chunks = ['{"severity": "high", "diagnoses": [{"name": "Misfire"}]}']
+        with patch.object(ai, '_stream_anthropic_text', side_effect=failing_stream), \
+                patch.object(ai, '_stream_openai_text', return_value=(chunk for chunk in openai_chunks)), \
+                patch.dict(_provider_slots, {'Anthropic': slot}):
+            stream = ai.analyze_dtcs_stream(dtcs, {'make': 'Honda'})
+            assert next(stream) == ('severity', 'low')
+            # The slot is released while the consumer handles an event
+            assert slot.acquire(blocking=False)
+            slot.release()
+            events = list(stream)
+
+        assert [event for event, _ in events] == ['diagnosis', 'reset', 'severity', 'diagnosis', 'analysis']
+        assert events[-1][1]['severity'] == 'high'
+
     def test_diagnostic_engine_obd2_analysis(self, app):
         """Test OBD2 diagnostic analysis engine."""
         with app.app_context():
@@ -259,21 +742,128 @@ class TestOBD2DiagnosticPro:
             assert len(results['diagnoses']) >= 2
             assert results['severity'] in ['low', 'medium', 'high', 'critical']
 
-    def test_dtc_database_initialization(self, app):
+    def test_diagnostic_engine_clean_scan_skips_ai(self):
+        """Test that a scan without codes or sensor anomalies is not sent to the AI."""
+        with patch('utils.diagnostic_engine.enhance_with_ai') as mock_enhance:
+            results = analyze_obd2_data([], [], {'make': 'Toyota'})
+
+        mock_enhance.assert_not_called()
+        assert results['severity'] == 'none'
+
+    def test_diagnostic_engine_stream(self):
+        """Test that the local analysis is yielded before the AI enhancement."""
+        from utils.diagnostic_engine import analyze_obd2_data_stream
+        dtcs = [Mock(code='P0420', description='Catalyst Efficiency Below Threshold', type='stored')]
+
+        with patch('utils.diagnostic_engine.enhance_with_ai', return_value={'severity': 'high'}):
+            events = list(analyze_obd2_data_stream(dtcs, [], {'make': 'Toyota'}))
+
+        assert [event for event, _ in events] == ['partial', 'final']
+        assert events[0][1]['severity'] == 'medium'
+        assert events[1][1]['severity'] == 'high'
+
+    def test_diagnostic_engine_dict_inputs(self):
+        """Test OBD2 analysis with DTCs and sensor readings passed as dictionaries."""
+        dtcs = [{'code': 'P0171', 'description': 'System Too Lean (Bank 1)', 'type': 'stored'}]
+        sensors = [{'name': 'SHORT_FUEL_TRIM_1', 'value': 15, 'unit': '%', 'pid': '0106'}]
+
+        with patch('utils.diagnostic_engine.enhance_with_ai', return_value=None):
+            results = analyze_obd2_data(dtcs, sensors, {'make': 'Toyota'})
+
+        names = [diagnosis['name'] for diagnosis in results['diagnoses']]
+        assert names == ['P0171', 'Fuel System Running Lean']
+        assert results['severity'] == 'high'
+
+    def test_diagnostic_engine_columnar_sensors(self):
+        """Test OBD2 analysis with column-oriented sensor readings."""
+        sensors = {
+            'name': ['RPM', 'COOLANT_TEMP'],
+            'value': [1500, 90],
+            'unit': ['rpm', '°C'],
+            'pid': ['010C', '0105']
+        }
+
+        with patch('utils.diagnostic_engine.enhance_with_ai', return_value=None):
+            results = analyze_obd2_data([], sensors, {'make': 'Toyota'})
+
+        names = [diagnosis['name'] for diagnosis in results['diagnoses']]
+        assert 'High Idle RPM' in names
+
+    def test_diagnostic_engine_structured_array_sensors(self):
+        """Test OBD2 analysis with a NumPy structured array of sensor readings."""
+        np = pytest.importorskip('numpy')
+        sensors = np.array(
+            [('RPM', 800, 'rpm', '010C'), ('COOLANT_TEMP', 105, 'C', '0105')],
+            dtype=[('name', 'U32'), ('value', 'f8'), ('unit', 'U8'), ('pid', 'U4')]
+        )
+
+        with patch('utils.diagnostic_engine.enhance_with_ai', return_value=None):
+            results = analyze_obd2_data([], sensors, {'make': 'Toyota'})
+
+        names = [diagnosis['name'] for diagnosis in results['diagnoses']]
+        assert 'Engine Overheating' in names
+
+    def test_enhance_with_ai_uses_available_provider(self, ai):
+        """Test that AI enhancement falls through to OpenAI when only OpenAI is configured."""
+        from utils.diagnostic_engine import enhance_with_ai
+        results = {'diagnoses': [], 'severity': 'medium'}
+
+        with patch('utils.diagnostic_engine.get_diagnostic_ai', return_value=ai) as mock_get, \
+                patch.object(ai, '_analyze_with_openai', return_value={'enhanced_severity': 'high'}):
+            enhanced = enhance_with_ai(results, [], {}, {'make': 'Toyota'})
+
+        mock_get.assert_called_once_with(use_openai=True, use_anthropic=True)
+
+        assert enhanced == {'severity': 'high'}
+
+    def test_free_form_prompt_responses_cached(self, ai):
+        """Test that free-form AI prompts are answered from the cache when repeated."""
+        with patch.object(ai, '_analyze_with_openai', return_value={'enhanced_severity': 'low'}) as mock_call:
+            assert ai.analyze_prompt('Enhance these results') == ('OpenAI', {'enhanced_severity': 'low'})
+            assert ai.analyze_prompt('Enhance these results') == ('OpenAI', {'enhanced_severity': 'low'})
+            ai.analyze_prompt('Enhance other results')
+
+        assert mock_call.call_count == 2
+
+    def test_dtc_info_cache_returns_copies(self):
+        """Test that changing a looked-up DTC does not change later lookups."""
+        from utils.dtc_database import DTCDatabaseManager
+
+        manager = DTCDatabaseManager()
+        dtc = Mock(code='P0301', description='Cylinder 1 Misfire', likely_causes='', symptoms='',
+                   severity='high', notes='')
+        with patch('utils.dtc_database.DtcDatabase') as mock_model:
+            mock_model.query.filter_by.return_value.first.return_value = dtc
+            first = manager.get_dtc_info('p0301')
+            first['severity'] = 'low'
+            second = manager.get_dtc_info('P0301')
+            second['enhanced'] = True
+
+        assert manager.get_dtc_info('P0301') == {
+            'code': 'P0301', 'description': 'Cylinder 1 Misfire', 'likely_causes': '', 'symptoms': '',
+            'severity': 'high', 'notes': ''
+        }
+        assert mock_model.query.filter_by.call_count == 1
+
+    def test_dtc_database_initialization(self, dtc_lookup):
         """Test DTC database initialization."""
+        # Test getting specific DTC info
+        p0301_info = dtc_lookup['p0301']
+        assert p0301_info is not None
+        assert p0301_info['code'] == 'P0301'
+        assert 'misfire' in p0301_info['description'].lower()
+        
+        # Test searching DTCs
+        misfire_codes = dtc_lookup['misfire']
+        assert isinstance(misfire_codes, list)
+        assert len(misfire_codes) > 0
+
+    def test_dtc_info_cached(self, app, dtc_lookup):
+        """Test that repeated DTC lookups are served from the cache."""
+        from utils.dtc_database import get_dtc_info
+        
         with app.app_context():
-            from utils.dtc_database import get_dtc_info, search_dtcs
-            
-            # Test getting specific DTC info
-            p0301_info = get_dtc_info('P0301')
-            assert p0301_info is not None
-            assert p0301_info['code'] == 'P0301'
-            assert 'misfire' in p0301_info['description'].lower()
-            
-            # Test searching DTCs
-            misfire_codes = search_dtcs('misfire')
-            assert isinstance(misfire_codes, list)
-            assert len(misfire_codes) > 0
+            assert get_dtc_info('p0301') is dtc_lookup['p0301']
 
     def test_database_models(self, app):
         """Test database models and relationships."""
@@ -325,22 +915,22 @@ class TestOBD2DiagnosticPro:
             assert len(session.sensor_readings) == 1
             assert session.dtcs[0].code == 'P0301'
 
-    def test_error_handling(self, client):
+    def test_error_handling(self, client_fresh):
         """Test error handling in various scenarios."""
         # Test accessing protected routes without setup
-        response = client.get('/obd2/dashboard')
+        response = client_fresh.get('/obd2/dashboard')
         # Should redirect to connect page or show empty dashboard
         assert response.status_code in [200, 302]
         
         # Test invalid API calls
-        response = client.get('/api/obd2/live-data')
+        response = client_fresh.get('/api/obd2/live-data')
         data = response.get_json()
         # Should handle gracefully even without vehicle setup
         assert response.status_code in [200, 400]
 
-    def test_session_management(self, client, app):
+    def test_session_management(self, client_fresh, app):
         """Test session management functionality."""
-        with client.session_transaction() as sess:
+        with client_fresh.session_transaction() as sess:
             sess['vehicle_info'] = {
                 'make': 'Honda',
                 'model': 'Accord',
@@ -350,22 +940,22 @@ class TestOBD2DiagnosticPro:
             sess['vehicle_id'] = 1
         
         # Test that session data persists
-        response = client.get('/obd2/dashboard')
+        response = client_fresh.get('/obd2/dashboard')
         assert response.status_code == 200
 
-    def test_reset_functionality(self, client):
+    def test_reset_functionality(self, client_fresh):
         """Test session reset functionality."""
         # Set some session data
-        with client.session_transaction() as sess:
+        with client_fresh.session_transaction() as sess:
             sess['vehicle_info'] = {'make': 'Test'}
             sess['vehicle_id'] = 1
         
         # Reset session
-        response = client.get('/reset')
+        response = client_fresh.get('/reset')
         assert response.status_code == 302  # Should redirect
         
         # Verify session is cleared
-        with client.session_transaction() as sess:
+        with client_fresh.session_transaction() as sess:
             assert 'vehicle_info' not in sess
             assert 'vehicle_id' not in sess
 
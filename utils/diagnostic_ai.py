@@ -3,30 +3,1404 @@ Diagnostic AI Module
 This module uses AI models to enhance vehicle diagnostics and provide repair recommendations.
 """
 
+import atexit
+import copy
+import functools
+import hashlib
 import json
 import logging
 import os
+import random
+import re
 import sys
-from typing import Dict, List, Any, Optional
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field, fields
+from typing import Callable, Dict, Generator, Iterator, List, Any, Optional, Tuple, Union
+
+# Use orjson for faster parsing of AI responses when it is installed
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers only catch the latter
+_loads = orjson.loads if HAS_ORJSON else json.loads
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache with expiry for parsed AI responses.
+    
+    Entries are deep-copied on the way in and out so callers can freely
+    modify the dictionaries they get back.
+    """
+    
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600.0):
+        """
+        Initialize the cache.
+        
+        Args:
+            maxsize: Maximum number of responses to keep
+            ttl: Time in seconds before a cached response expires
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> Optional[Dict]:
+        """
+        Get a cached response.
+        
+        Args:
+            key: Cache key
+            
+        Returns:
+            Copy of the cached response, or None if missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        return copy.deepcopy(value)
+    
+    def set(self, key: str, value: Dict) -> None:
+        """
+        Store a response, evicting the least recently used one if full.
+        
+        Args:
+            key: Cache key
+            value: Parsed response to cache
+        """
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+    
+    def clear(self) -> None:
+        """Remove all cached responses."""
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by all DiagnosticAI instances, since callers create one per request. Keys ignore
+# the VIN and band the mileage, so entries expire after an hour rather than serving
+# another vehicle's analysis for longer
+_response_cache = ResponseCache(maxsize=1024, ttl=3600.0)
+
+# Futures of the AI requests currently in flight, keyed by cache key
+_inflight: Dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+
+
+def _single_flight(key: str, compute: Callable[[], Any]) -> Any:
+    """
+    Run compute once for concurrent requests with the same cache key.
+    
+    While a request is in flight, identical requests wait for its result
+    instead of calling the AI providers again. Each waiting caller gets its
+    own copy of the result.
+    
+    Args:
+        key: Cache key of the request
+        compute: Function that performs the request
+        
+    Returns:
+        The result of compute
+    """
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            _inflight[key] = future
+    
+    if not leader:
+        return copy.deepcopy(future.result())
+    
+    try:
+        result = compute()
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(copy.deepcopy(result))
+        return result
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+
+
+class CircuitBreaker:
+    """
+    Failure counter that stops calling a provider after repeated failures.
+    
+    Once failure_threshold consecutive calls have failed, the breaker opens
+    and the provider is skipped for reset_timeout seconds. After that a
+    single probe call is let through while other callers keep skipping the
+    provider; a success closes the breaker and another failure opens it for
+    a further reset_timeout seconds. A probe whose outcome is never recorded,
+    because it was cancelled, is replaced by a new one after reset_timeout.
+    Opening and closing are logged once each, not for every skipped call.
+    """
+    
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        """
+        Initialize the breaker.
+        
+        Args:
+            name: Provider name, for logging
+            failure_threshold: Consecutive failures before the breaker opens
+            reset_timeout: Time in seconds to skip the provider once open
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+    
+    def allow(self) -> bool:
+        """
+        Check whether the provider may be called.
+        
+        Returns:
+            False while the breaker is open or a probe call is running,
+            True otherwise
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._open_until:
+                return False
+            if self._failures >= self.failure_threshold:
+                # Half open: this caller is the probe, so skip the provider for the others
+                self._open_until = now + self.reset_timeout
+            return True
+    
+    def record_success(self) -> None:
+        """Close the breaker after a successful call."""
+        with self._lock:
+            if self._failures >= self.failure_threshold:
+                logger.warning(f"{self.name} circuit breaker closed, provider is responding again")
+            self._failures = 0
+            self._open_until = 0.0
+    
+    def record_failure(self) -> None:
+        """Count a failed call, opening the breaker at the threshold."""
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._failures == self.failure_threshold:
+                    logger.warning(
+                        f"{self.name} circuit breaker opened after {self._failures} consecutive failures, "
+                        f"skipping the provider for {self.reset_timeout:g}s"
+                    )
+                self._open_until = time.monotonic() + self.reset_timeout
+
+
+# JSON structure requested from the AI for a DTC analysis
+_DTC_ANALYSIS_FORMAT = """{
+  "severity": "critical|high|medium|low|none",
+  "diagnoses": [
+    {
+      "name": "Short name of the diagnosis",
+      "description": "Detailed description of the problem",
+      "confidence": 0.0-1.0,
+      "severity": "critical|high|medium|low|none"
+    }
+  ],
+  "diy_repairs": [
+    {
+      "issue_name": "Name of the issue being repaired",
+      "repair_name": "Name of the repair procedure",
+      "description": "Detailed description of the repair",
+      "difficulty": 1-5,
+      "estimated_cost": "$XX-$YY",
+      "steps": ["Step 1", "Step 2", "..."]
+    }
+  ],
+  "professional_repairs": [
+    {
+      "issue_name": "Name of the issue being repaired",
+      "repair_name": "Name of the repair procedure",
+      "description": "Detailed description of the repair",
+      "estimated_cost": "$XX-$YY"
+    }
+  ],
+  "safety_warnings": [
+    {
+      "text": "Warning text",
+      "issue_name": "Related issue"
+    }
+  ]
+}"""
+
+# JSON structure requested from the AI for a sensor data analysis
+_SENSOR_ANALYSIS_FORMAT = """{
+  "analysis": "Overall analysis of the sensor data",
+  "anomalies": [
+    {
+      "sensor": "Name of sensor with anomalous reading",
+      "reading": "The reading value",
+      "normal_range": "The normal range for this sensor",
+      "severity": "critical|high|medium|low|none",
+      "possible_causes": ["Cause 1", "Cause 2"]
+    }
+  ],
+  "potential_issues": [
+    {
+      "name": "Name of potential issue",
+      "description": "Description of the issue",
+      "confidence": 0.0-1.0,
+      "related_sensors": ["Sensor 1", "Sensor 2"]
+    }
+  ],
+  "recommendations": [
+    "Recommendation 1",
+    "Recommendation 2"
+  ],
+  "severity": "critical|high|medium|low|none"
+}"""
+
+# JSON structure requested from the AI for a repair guide
+_REPAIR_GUIDE_FORMAT = """{
+  "repair_name": "Name of the repair procedure",
+  "description": "Overall description of the repair",
+  "tools_needed": ["Tool 1", "Tool 2", "..."],
+  "parts_needed": [
+    {
+      "name": "Part name",
+      "estimated_cost": "$XX-$YY",
+      "part_number": "OEM or aftermarket part number (if available)"
+    }
+  ],
+  "difficulty": 1-5,
+  "estimated_time": "X-Y hours",
+  "safety_precautions": ["Precaution 1", "Precaution 2", "..."],
+  "steps": ["Step 1", "Step 2", "..."],
+  "tips": ["Tip 1", "Tip 2", "..."]
+}"""
+
+# Defaults for the top-level fields of each response structure. Missing fields and
+# fields of the wrong type in an AI response are replaced with these
+_DTC_ANALYSIS_DEFAULTS = {
+    "diagnoses": [],
+    "severity": "medium",
+    "diy_repairs": [],
+    "professional_repairs": [],
+    "safety_warnings": []
+}
+_SENSOR_ANALYSIS_DEFAULTS = {
+    "analysis": "",
+    "anomalies": [],
+    "potential_issues": [],
+    "recommendations": [],
+    "severity": "none"
+}
+_REPAIR_GUIDE_DEFAULTS = {
+    "repair_name": "",
+    "description": "",
+    "tools_needed": [],
+    "parts_needed": [],
+    "difficulty": 3,
+    "estimated_time": "Unknown",
+    "safety_precautions": [],
+    "steps": [],
+    "tips": []
+}
+
+def _strict_object(properties: Dict[str, Dict]) -> Dict:
+    """
+    Build a JSON Schema object in which every property is required.
+    
+    Args:
+        properties: Schema of each property
+        
+    Returns:
+        Object schema that allows no other properties, as strict structured outputs require
+    """
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False
+    }
+
+
+def _json_schema_format(name: str, schema: Dict) -> Dict:
+    """
+    Build a response_format that enforces a JSON Schema while decoding.
+    
+    OpenAI takes it as is, Anthropic requests turn it into a forced tool call.
+    
+    Args:
+        name: Name of the response structure
+        schema: JSON Schema of the response
+        
+    Returns:
+        response_format parameter for chat completions
+    """
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+
+# JSON Schemas of the response structures, enforced by OpenAI's structured outputs and
+# Anthropic's forced tool use so that responses always parse and contain every field
+_STRING = {"type": "string"}
+_STRING_LIST = {"type": "array", "items": _STRING}
+_SEVERITY = {"type": "string", "enum": ["critical", "high", "medium", "low", "none"]}
+_DTC_ANALYSIS_SCHEMA = _strict_object({
+    "severity": _SEVERITY,
+    "diagnoses": {"type": "array", "items": _strict_object({
+        "name": _STRING,
+        "description": _STRING,
+        "confidence": {"type": "number"},
+        "severity": _SEVERITY
+    })},
+    "diy_repairs": {"type": "array", "items": _strict_object({
+        "issue_name": _STRING,
+        "repair_name": _STRING,
+        "description": _STRING,
+        "difficulty": {"type": "integer"},
+        "estimated_cost": _STRING,
+        "steps": _STRING_LIST
+    })},
+    "professional_repairs": {"type": "array", "items": _strict_object({
+        "issue_name": _STRING,
+        "repair_name": _STRING,
+        "description": _STRING,
+        "estimated_cost": _STRING
+    })},
+    "safety_warnings": {"type": "array", "items": _strict_object({
+        "text": _STRING,
+        "issue_name": _STRING
+    })}
+})
+_DTC_RESPONSE_FORMAT = _json_schema_format("dtc_analysis", _DTC_ANALYSIS_SCHEMA)
+_DTC_BATCH_RESPONSE_FORMAT = _json_schema_format("dtc_analysis_batch", _strict_object({
+    "results": {"type": "array", "items": _DTC_ANALYSIS_SCHEMA}
+}))
+_SENSOR_RESPONSE_FORMAT = _json_schema_format("sensor_analysis", _strict_object({
+    "analysis": _STRING,
+    "anomalies": {"type": "array", "items": _strict_object({
+        "sensor": _STRING,
+        "reading": _STRING,
+        "normal_range": _STRING,
+        "severity": _SEVERITY,
+        "possible_causes": _STRING_LIST
+    })},
+    "potential_issues": {"type": "array", "items": _strict_object({
+        "name": _STRING,
+        "description": _STRING,
+        "confidence": {"type": "number"},
+        "related_sensors": _STRING_LIST
+    })},
+    "recommendations": _STRING_LIST,
+    "severity": _SEVERITY
+}))
+_REPAIR_RESPONSE_FORMAT = _json_schema_format("repair_guide", _strict_object({
+    "repair_name": _STRING,
+    "description": _STRING,
+    "tools_needed": _STRING_LIST,
+    "parts_needed": {"type": "array", "items": _strict_object({
+        "name": _STRING,
+        "estimated_cost": _STRING,
+        "part_number": _STRING
+    })},
+    "difficulty": {"type": "integer"},
+    "estimated_time": _STRING,
+    "safety_precautions": _STRING_LIST,
+    "steps": _STRING_LIST,
+    "tips": _STRING_LIST
+}))
+
+# System prompts hold the static instructions and response structure, so the prompt of
+# each request only carries the vehicle and its codes or readings. They are marked for
+# Anthropic prompt caching, but each is a few hundred tokens, below the 1024-token
+# minimum prefix Claude 3.5 Sonnet caches, so they are not cached at their current size
+_DTC_SYSTEM_PROMPT = f"""You are an expert automotive diagnostic assistant. You analyze DTCs (Diagnostic Trouble Codes) for a vehicle and provide a detailed analysis.
+
+Based on the DTCs and the vehicle information you are given, please provide:
+1. A detailed analysis of the likely problems in the vehicle
+2. The severity of the issues (critical, high, medium, low, or none)
+3. Recommended repair options, including DIY fixes where possible
+4. Estimated costs for repairs
+5. Any safety warnings the owner should be aware of
+
+Format your response as a JSON object with the following structure:
+{_DTC_ANALYSIS_FORMAT}
+
+Provide only the JSON response, with no additional text before or after."""
+
+_SENSOR_SYSTEM_PROMPT = f"""You are an expert automotive diagnostic assistant. You analyze live sensor data from a vehicle's OBD2 system and provide insights.
+
+Based on the sensor readings and the vehicle information you are given, please provide:
+1. An analysis of whether these readings are normal or indicate potential issues
+2. Any anomalies or concerning values in the data
+3. Possible issues that might be developing based on these readings
+4. Recommended actions the owner should take
+
+Format your response as a JSON object with the following structure:
+{_SENSOR_ANALYSIS_FORMAT}
+
+Provide only the JSON response, with no additional text before or after."""
+
+_REPAIR_SYSTEM_PROMPT = f"""You are an expert automotive repair technician. You create detailed repair guides for specific issues.
+
+For the issue and vehicle you are given, please provide a detailed repair guide including:
+1. A list of necessary tools and parts
+2. Step-by-step instructions
+3. Safety precautions
+4. Estimated time required
+5. Difficulty level (1-5, where 1 is easiest)
+6. Estimated cost range for parts
+
+Format your response as a JSON object with the following structure:
+{_REPAIR_GUIDE_FORMAT}
+
+Provide only the JSON response, with no additional text before or after."""
+
+# Per-request prompt templates, filled in with str.format_map. The vehicle block is
+# rendered once per VehicleInfo and starts every prompt
+_VEHICLE_BLOCK_TEMPLATE = """Vehicle Information:
+- Year: {year}
+- Make: {make}
+- Model: {model}
+- Mileage: {mileage}
+- VIN: {vin}"""
+
+_DTC_PROMPT_TEMPLATE = """{vehicle_block}
+
+Diagnostic Trouble Codes:
+{dtc_list}"""
+
+_SENSOR_PROMPT_TEMPLATE = """{vehicle_block}
+
+Sensor Readings:
+{sensor_list}"""
+
+_REPAIR_PROMPT_TEMPLATE = """{vehicle_block}
+
+Issue to Fix: {issue}"""
+
+# Threshold rules for the basic sensor analysis, checked in order. A rule fires when the
+# sensor reads above its limit and, if max_speed is set, the vehicle is slower than that
+_BASIC_SENSOR_RULES = (
+    {
+        "sensor": "coolant_temp",
+        "limit": 100,  # Over 100°C is concerning
+        "max_speed": None,
+        "name": "Engine Coolant Temperature",
+        "unit": "°C",
+        "normal_range": "80-95 °C",
+        "severity": "high",
+        "possible_causes": ("Low coolant level", "Faulty thermostat", "Cooling system issue"),
+        "issue_name": "Engine Overheating",
+        "issue_description": "Engine temperature is higher than normal operating range",
+        "confidence": 0.8,
+        "related_sensors": ("coolant_temp",),
+        "analysis": "Engine temperature is higher than normal. This could indicate cooling system issues."
+    },
+    {
+        "sensor": "rpm",
+        "limit": 1000,
+        "max_speed": 5,  # High RPM but not moving
+        "name": "Engine RPM",
+        "unit": "RPM",
+        "normal_range": "700-900 RPM (idle)",
+        "severity": "medium",
+        "possible_causes": ("Vacuum leak", "Idle control issue", "Throttle body problem"),
+        "issue_name": "High Idle RPM",
+        "issue_description": "Engine is idling at a higher than normal RPM",
+        "confidence": 0.7,
+        "related_sensors": ("rpm", "speed"),
+        "analysis": "Engine is idling at a higher than normal RPM, which could indicate vacuum leaks or idle control issues."
+    }
+)
+
+_SEVERITY_RANK = {"none": 0, "low": 1, "medium": 2, "high": 3, "critical": 4}
+
+# Worker threads used to call both AI providers concurrently
+_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="diagnostic-ai")
+
+# Worker threads that run whole analyses submitted in the background. Kept apart from
+# _executor, since each analysis waits on provider calls running there
+BACKGROUND_WORKERS = 4
+_background_executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="diagnostic-job")
+
+# Maximum number of concurrent outbound calls per provider, to respect rate limits
+MAX_CONCURRENT_CALLS = 8
+_provider_slots = {
+    "Anthropic": threading.BoundedSemaphore(MAX_CONCURRENT_CALLS),
+    "OpenAI": threading.BoundedSemaphore(MAX_CONCURRENT_CALLS)
+}
+
+# Per-provider circuit breakers, so a provider that keeps failing is skipped for a while
+_breakers = {
+    "Anthropic": CircuitBreaker("Anthropic"),
+    "OpenAI": CircuitBreaker("OpenAI")
+}
+
+# Default timeout in seconds for each AI request. Responses are streamed, so this bounds
+# each wait for more data rather than the whole response: a provider that stops sending
+# fails after it, one that keeps sending slowly does not. Opening a connection gets a
+# much shorter limit, so an unreachable host fails faster
+REQUEST_TIMEOUT = 15.0
+CONNECT_TIMEOUT = 5.0
+
+# Output token limit for a single analysis. Batched analyses get a limit per case,
+# capped at the most the models can generate in one response
+MAX_OUTPUT_TOKENS = 4000
+BATCH_TOKENS_PER_CASE = 1500
+MODEL_MAX_OUTPUT_TOKENS = 8192
+
+# Most cases sent in one batched request, so that every case gets its full allowance,
+# and the number of batched requests run at once
+BATCH_SIZE = MODEL_MAX_OUTPUT_TOKENS // BATCH_TOKENS_PER_CASE
+MAX_CONCURRENT_BATCHES = 4
+
+# Worker threads that send the groups of a batched analysis concurrently. Each group
+# waits on provider calls running in _executor
+_batch_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_BATCHES, thread_name_prefix="diagnostic-batch")
+
+# Sampling temperature for every AI request. Diagnoses should not vary between
+# identical requests, which is also what makes caching their responses sound
+TEMPERATURE = 0.0
+
+# Output token limits sized to the request, so short answers do not reserve a full
+# MAX_OUTPUT_TOKENS: a base allowance plus an allowance per code or reading
+DTC_BASE_TOKENS = 1200
+DTC_TOKENS_PER_CODE = 400
+SENSOR_BASE_TOKENS = 1000
+SENSOR_TOKENS_PER_READING = 60
+REPAIR_GUIDE_TOKENS = 3000
+
+
+# SDK clients keyed by (provider, API key), shared by all DiagnosticAI instances
+_clients: Dict[Tuple[str, str], Any] = {}
+_clients_lock = threading.Lock()
+
+# Connection pool shared by both SDK clients, created with the first client
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 50
+_http_client = None
+
+# Transient SDK errors that are retried before giving up on a provider. Filled in
+# when the SDK is imported, since the exception classes come from the SDK
+_retryable_errors: Dict[str, Tuple[type, ...]] = {"Anthropic": (), "OpenAI": ()}
+
+# Attempts per request, and the delay cap before the first retry (grows 4x per retry)
+MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.1
+
+# Longest Retry-After (seconds) worth waiting for; past it the error is raised so
+# the other provider can answer instead
+MAX_RETRY_AFTER = 10.0
+
+
+def _shared_http_client() -> Any:
+    """
+    Get the HTTP client shared by the Anthropic and OpenAI SDK clients.
+    
+    Must be called with _clients_lock held. The client is closed when the
+    process exits.
+    
+    Returns:
+        httpx.Client with a bounded keep-alive connection pool, or None if
+        httpx cannot be imported and each SDK should use its own client
+    """
+    global _http_client
+    if _http_client is None:
+        try:
+            import httpx
+        except ImportError:
+            return None
+        _http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS
+            ),
+            timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT),
+            follow_redirects=True
+        )
+        atexit.register(_http_client.close)
+    return _http_client
+
+
+def _request_timeout(timeout: float) -> Any:
+    """
+    Build the timeout of one AI request attempt.
+    
+    A per-request timeout replaces the timeout of the shared HTTP client, so
+    the short connect timeout has to be carried into it.
+    
+    Args:
+        timeout: Timeout in seconds for each read of the response, not for
+            the whole attempt
+        
+    Returns:
+        httpx.Timeout with connect capped at CONNECT_TIMEOUT, or timeout
+        itself if httpx cannot be imported
+    """
+    try:
+        import httpx
+    except ImportError:
+        return timeout
+    return httpx.Timeout(timeout, connect=min(timeout, CONNECT_TIMEOUT))
+
+
+def _shared_client(provider: str, api_key: str) -> Any:
+    """
+    Get the SDK client for a provider, creating it on first use.
+    
+    The SDK is only imported when the first client is created, and the
+    client is reused by later DiagnosticAI instances. Both SDKs send their
+    requests through one shared connection pool, which stays warm between
+    requests. The SDK's own retries are disabled because transient errors
+    are retried by _with_retries.
+    
+    Args:
+        provider: Provider name ('Anthropic' or 'OpenAI')
+        api_key: API key for the provider
+        
+    Returns:
+        Anthropic or OpenAI client
+    """
+    with _clients_lock:
+        client = _clients.get((provider, api_key))
+        if client is None:
+            if provider == "Anthropic":
+                from anthropic import Anthropic, APITimeoutError, InternalServerError, RateLimitError
+                client = Anthropic(api_key=api_key, max_retries=0, http_client=_shared_http_client())
+            else:
+                from openai import OpenAI, APITimeoutError, InternalServerError, RateLimitError
+                client = OpenAI(api_key=api_key, max_retries=0, http_client=_shared_http_client())
+            _retryable_errors[provider] = (RateLimitError, APITimeoutError, InternalServerError)
+            _clients[(provider, api_key)] = client
+    return client
+
+
+def _with_retries(provider: str, call: Callable[[], Any]) -> Any:
+    """
+    Run a provider request, retrying transient errors with exponential backoff.
+    
+    Timeouts and server errors usually clear within a second, so retrying the
+    same provider is cheaper than falling back to the other one. Each delay is
+    drawn at random up to a cap that grows fourfold per attempt, so concurrent
+    callers do not retry in step. A rate limit is not retried before the
+    Retry-After the provider sent, and is raised at once if that is longer
+    than MAX_RETRY_AFTER. Once the current call is cancelled, no further
+    attempt is made and the backoff is cut short.
+    
+    Args:
+        provider: Provider name ('Anthropic' or 'OpenAI')
+        call: Function that performs the request
+        
+    Returns:
+        The result of call
+        
+    Raises:
+        _CallCancelled: If another provider answered first
+        The last error if all attempts fail, or any non-transient error
+    """
+    cancelled = getattr(_call_state, 'cancelled', None)
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        if cancelled is not None and cancelled.is_set():
+            raise _CallCancelled()
+        try:
+            return call()
+        except _retryable_errors[provider] as e:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            delay = random.uniform(0, RETRY_BASE_DELAY * 4 ** (attempt - 1))
+            retry_after = _retry_after(e)
+            if retry_after is not None:
+                if retry_after > MAX_RETRY_AFTER:
+                    raise
+                delay = max(delay, retry_after)
+            logger.warning(f"Transient error from {provider}, retrying in {delay:.2f}s: {e}")
+            if cancelled is None:
+                time.sleep(delay)
+            elif cancelled.wait(delay):
+                raise _CallCancelled()
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """
+    Read the delay a provider asked for before retrying a request.
+    
+    Args:
+        error: Error raised by the SDK
+        
+    Returns:
+        Delay in seconds from the retry-after-ms or retry-after header, or None
+        if the error has no response or the header is missing or not a number
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return float(headers[header]) * scale
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+class _CallCancelled(Exception):
+    """Raised inside a provider call once another provider has already answered."""
+
+
+# Cancellation flag of the provider call running in the current thread, if any
+_call_state = threading.local()
+
+
+def _collect_stream(chunks: Generator[str, None, None]) -> str:
+    """
+    Join a streamed JSON response, stopping as soon as it is complete.
+    
+    The stream is closed once the JSON object in the response has been
+    closed, or once the current call is cancelled. This releases the
+    connection and stops generating tokens that nobody reads, such as
+    closing remarks after the JSON.
+    
+    Args:
+        chunks: Generator of response text chunks
+        
+    Returns:
+        The response text up to the end of the JSON object
+        
+    Raises:
+        _CallCancelled: If another provider answered first
+    """
+    cancelled = getattr(_call_state, 'cancelled', None)
+    scanner = _JsonEndScanner()
+    parts = []
+    try:
+        for chunk in chunks:
+            if cancelled is not None and cancelled.is_set():
+                raise _CallCancelled()
+            parts.append(chunk[:scanner.feed(chunk)])
+            if scanner.complete:
+                break
+    finally:
+        chunks.close()
+    return "".join(parts)
+
+
+def _call_provider(provider: str, call: Callable[[], Optional[Dict]],
+                   cancelled: Optional[threading.Event] = None) -> Optional[Dict]:
+    """
+    Call an AI provider, limiting the number of concurrent calls to it.
+    
+    The outcome is recorded on the provider's circuit breaker, unless the
+    call was cancelled because another provider answered first.
+    
+    Args:
+        provider: Provider name ('Anthropic' or 'OpenAI')
+        call: Function that performs the call
+        cancelled: Optional event that is set to abandon the call
+        
+    Returns:
+        The provider result, or None if the call failed
+    """
+    with _provider_slots[provider]:
+        _call_state.cancelled = cancelled
+        try:
+            result = call()
+        except Exception as e:
+            logger.error(f"Error calling {provider}: {e}")
+            result = None
+        finally:
+            _call_state.cancelled = None
+    
+    if not result and cancelled is not None and cancelled.is_set():
+        return None
+    if result:
+        _breakers[provider].record_success()
+    else:
+        _breakers[provider].record_failure()
+    return result
+
+
+# Characters that change the brace depth or string state of JSON text. Scanning jumps
+# between these with the regex engine instead of stepping through every character
+_JSON_STRUCTURE_RE = re.compile(r'[{}"\\]')
+
+
+def _extract_json(text: str) -> Optional[str]:
+    """
+    Extract the first complete JSON object from an AI response.
+    
+    Walks the text once from the first opening brace, tracking the nesting
+    depth and ignoring braces inside JSON strings, so any prose or markdown
+    around the object is skipped in linear time.
+    
+    Args:
+        text: Response text that contains a JSON object
+        
+    Returns:
+        The JSON object text, or None if no complete object was found
+    """
+    start = text.find('{')
+    if start == -1:
+        return None
+    
+    depth = 0
+    in_string = False
+    escaped_index = -1
+    for match in _JSON_STRUCTURE_RE.finditer(text, start):
+        index = match.start()
+        if index == escaped_index:
+            continue
+        char = match.group()
+        if in_string:
+            if char == '\\':
+                escaped_index = index + 1
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:index + 1]
+    
+    return None
+
+
+class _JsonEndScanner:
+    """
+    Incremental scanner that finds the end of the first JSON object in a streamed response.
+    
+    Like _extract_json, text before the first opening brace is skipped and
+    braces inside strings are ignored.
+    """
+    
+    def __init__(self):
+        """Initialize the scanner."""
+        self.complete = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+    
+    def feed(self, text: str) -> int:
+        """
+        Scan the next chunk of the response.
+        
+        Args:
+            text: Newly received response text
+            
+        Returns:
+            Length of the part of text up to and including the closing brace
+            of the object, or len(text) if the object is not complete yet
+        """
+        # An escape at the end of the previous chunk applies to this chunk's first character
+        escaped_index = 0 if self._escaped else -1
+        for match in _JSON_STRUCTURE_RE.finditer(text):
+            index = match.start()
+            if index == escaped_index:
+                continue
+            char = match.group()
+            if self._in_string:
+                if char == '\\':
+                    escaped_index = index + 1
+                elif char == '"':
+                    self._in_string = False
+            elif char == '{':
+                self._depth += 1
+            elif self._depth:
+                if char == '"':
+                    self._in_string = True
+                elif char == '}':
+                    self._depth -= 1
+                    if self._depth == 0:
+                        self.complete = True
+                        return index + 1
+        self._escaped = escaped_index == len(text)
+        return len(text)
+
+
+class _ResponseScanner:
+    """
+    Incremental scanner that picks complete parts out of a streamed JSON object.
+    
+    Text is fed in as it arrives from the AI provider. Each object in the
+    top-level array named by array_key is returned as soon as its closing
+    brace has been received, and so is each top-level string field named
+    in field_keys. Callers can show the severity and the first diagnoses
+    while the rest of the response is still being generated.
+    """
+    
+    def __init__(self, array_key: str, field_keys: Tuple[str, ...] = ()):
+        """
+        Initialize the scanner.
+        
+        Args:
+            array_key: Name of the top-level array whose items are returned
+            field_keys: Names of the top-level string fields that are returned
+        """
+        self.array_key = array_key
+        self.field_keys = field_keys
+        self.complete = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._key_chars: List[str] = []
+        self._last_key: Optional[str] = None
+        self._expect_value = False
+        self._in_array = False
+        self._item_chars: Optional[List[str]] = None
+    
+    def feed(self, text: str) -> List[Tuple[str, Any]]:
+        """
+        Scan the next chunk of the response.
+        
+        Args:
+            text: Newly received response text
+            
+        Returns:
+            List of (array_key, item) for each array item and (key, value) for
+            each requested field completed by this chunk, in response order
+        """
+        parts = []
+        for char in text:
+            if self.complete:
+                break
+            if self._item_chars is not None:
+                self._item_chars.append(char)
+            
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        if not self._expect_value:
+                            self._last_key = "".join(self._key_chars)
+                        elif self._last_key in self.field_keys:
+                            try:
+                                parts.append((self._last_key, _loads('"' + "".join(self._key_chars) + '"')))
+                            except json.JSONDecodeError:
+                                logger.warning("Skipping malformed field in streamed AI response")
+                        self._expect_value = False
+                    continue
+                if self._depth == 1:
+                    self._key_chars.append(char)
+            elif char == '"':
+                self._in_string = True
+                if self._depth == 1:
+                    self._key_chars = []
+            elif self._depth == 1 and char in ':,':
+                self._expect_value = char == ':'
+            elif char in '{[':
+                if char == '[' and self._depth == 1 and self._last_key == self.array_key:
+                    self._in_array = True
+                self._expect_value = False
+                self._depth += 1
+                if char == '{' and self._in_array and self._depth == 3:
+                    self._item_chars = [char]
+            elif char in '}]':
+                self._depth -= 1
+                if self._item_chars is not None and self._depth == 2:
+                    try:
+                        parts.append((self.array_key, _loads("".join(self._item_chars))))
+                    except json.JSONDecodeError:
+                        logger.warning("Skipping malformed item in streamed AI response")
+                    self._item_chars = None
+                elif self._in_array and self._depth == 1:
+                    self._in_array = False
+                elif self._depth == 0:
+                    self.complete = True
+        
+        return parts
+
+
+def _cached_system(system: str) -> List[Dict]:
+    """
+    Build an Anthropic system parameter marked for prompt caching.
+    
+    Anthropic only caches a prefix of at least 1024 tokens, so the mark has
+    no effect until the tools and system prompt reach that size; the
+    usage logged for each request shows whether anything was cached.
+    
+    Args:
+        system: Static system prompt
+        
+    Returns:
+        List with a single text block marked as an ephemeral cache breakpoint
+    """
+    return [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+
+
+def _parse_ai_json(text: str, provider: str) -> Optional[Dict]:
+    """
+    Parse the JSON object in an AI response.
+    
+    Args:
+        text: Complete response text
+        provider: Provider name, for logging
+        
+    Returns:
+        Parsed response, or None if it does not contain valid JSON
+    """
+    try:
+        return _loads(text)
+    except json.JSONDecodeError as e:
+        logger.error(f"Error parsing {provider} JSON response: {e}")
+    
+    # Try to extract just the JSON part
+    json_text = _extract_json(text)
+    if json_text:
+        try:
+            return _loads(json_text)
+        except json.JSONDecodeError:
+            logger.error(f"Failed to parse extracted JSON from {provider} response")
+    return None
+
+
+def _normalize_response(result: Any, defaults: Dict[str, Any]) -> Optional[Dict]:
+    """
+    Validate an AI response against the defaults of its structure.
+    
+    Missing fields and fields of the wrong type are replaced with their
+    default, and an unknown severity with the default severity, so callers
+    and templates can rely on every field being present. Extra fields are
+    kept.
+    
+    Args:
+        result: Parsed AI response
+        defaults: Default value of each top-level field
+        
+    Returns:
+        The response, updated in place, or None if it is not a JSON object
+    """
+    if not isinstance(result, dict):
+        return None
+    
+    for key, default in defaults.items():
+        if not isinstance(result.get(key), type(default)):
+            result[key] = copy.copy(default)
+    
+    if "severity" in defaults:
+        result["severity"] = _normalize_severity(result["severity"], defaults["severity"])
+    
+    return result
+
+
+def _normalize_severity(severity: Any, default: str) -> str:
+    """
+    Normalize a severity from an AI response.
+    
+    Args:
+        severity: Severity as given by the AI
+        default: Severity to use if it is not a known severity
+        
+    Returns:
+        The severity stripped and lowercased, or default if unknown
+    """
+    if not isinstance(severity, str):
+        return default
+    severity = severity.strip().lower()
+    return severity if severity in _SEVERITY_RANK else default
+
+
+@dataclass(slots=True, frozen=True)
+class VehicleInfo:
+    """
+    Vehicle details used in AI prompts, with 'Unknown' for anything not provided.
+    
+    The vehicle block that starts every prompt is rendered once, when the
+    instance is created, so requests that reuse the same VehicleInfo only
+    format their DTCs, sensor readings or issue.
+    """
+    year: Any = 'Unknown'
+    make: Any = 'Unknown'
+    model: Any = 'Unknown'
+    mileage: Any = 'Unknown'
+    vin: Any = 'Unknown'
+    prompt_block: str = field(init=False, repr=False, compare=False)
+    
+    def __post_init__(self):
+        object.__setattr__(self, 'prompt_block', _VEHICLE_BLOCK_TEMPLATE.format_map({
+            "year": self.year,
+            "make": self.make,
+            "model": self.model,
+            "mileage": self.mileage,
+            "vin": self.vin
+        }))
+    
+    @classmethod
+    def from_dict(cls, vehicle_info: Union['VehicleInfo', Dict]) -> 'VehicleInfo':
+        """
+        Normalize vehicle information once, at the public API boundary.
+        
+        Args:
+            vehicle_info: VehicleInfo, or dictionary with vehicle information
+            
+        Returns:
+            VehicleInfo instance
+        """
+        if isinstance(vehicle_info, cls):
+            return vehicle_info
+        return cls(**{name: vehicle_info.get(name, 'Unknown') for name in _VEHICLE_FIELDS})
+
+
+_VEHICLE_FIELDS = tuple(vehicle_field.name for vehicle_field in fields(VehicleInfo) if vehicle_field.init)
+
+
+class SensorFrame:
+    """
+    Sensor readings stored column-wise as parallel tuples of keys, values and units.
+    
+    The incoming dictionary of per-sensor dictionaries is converted once, so
+    the cache key, prompt and basic analysis iterate over flat tuples instead
+    of looking up 'value' and 'unit' in a small dictionary for every sensor.
+    """
+    
+    __slots__ = ('keys', 'values', 'units', '_positions')
+    
+    def __init__(self, keys: Tuple[str, ...], values: Tuple[Any, ...], units: Tuple[str, ...]):
+        """
+        Initialize the frame.
+        
+        Args:
+            keys: Sensor keys
+            values: Sensor values, None where a reading has no value
+            units: Sensor units
+        """
+        self.keys = keys
+        self.values = values
+        self.units = units
+        self._positions = {key: position for position, key in enumerate(keys)}
+    
+    @classmethod
+    def from_dict(cls, sensor_data: Union['SensorFrame', Dict]) -> 'SensorFrame':
+        """
+        Convert sensor readings once, at the public API boundary.
+        
+        Args:
+            sensor_data: SensorFrame, or dictionary of sensor readings
+            
+        Returns:
+            SensorFrame instance
+        """
+        if isinstance(sensor_data, cls):
+            return sensor_data
+        readings = tuple(sensor_data.values())
+        return cls(
+            tuple(sensor_data),
+            tuple(reading.get('value') for reading in readings),
+            tuple(reading.get('unit', '') for reading in readings)
+        )
+    
+    def __contains__(self, key: str) -> bool:
+        return key in self._positions
+    
+    def value(self, key: str, default: Any = None) -> Any:
+        """
+        Get the value of a sensor.
+        
+        Args:
+            key: Sensor key
+            default: Value returned if the sensor or its value is missing
+            
+        Returns:
+            Sensor value, or default
+        """
+        position = self._positions.get(key)
+        if position is None or self.values[position] is None:
+            return default
+        return self.values[position]
+
+
+def _vehicle_fingerprint(vehicle: VehicleInfo) -> List:
+    """
+    Build the vehicle part of a cache key.
+    
+    Mileage is bucketed to 10,000 so that near-identical requests share a
+    cache entry while vehicles at very different mileage do not.
+    
+    Args:
+        vehicle: Vehicle information
+        
+    Returns:
+        List of normalized year, make, model and mileage bucket
+    """
+    try:
+        mileage_bucket = int(vehicle.mileage) // 10000
+    except (TypeError, ValueError):
+        mileage_bucket = None
+    
+    return [
+        str(vehicle.year).strip(),
+        str(vehicle.make).strip().lower(),
+        str(vehicle.model).strip().lower(),
+        mileage_bucket
+    ]
+
+
+def _cache_key(kind: str, payload: Any, vehicle: VehicleInfo) -> str:
+    """
+    Compute a canonical cache key for an AI request.
+    
+    Args:
+        kind: Type of request ('dtc', 'sensor' or 'repair')
+        payload: JSON-serializable request data
+        vehicle: Vehicle information
+        
+    Returns:
+        Hex digest identifying the request
+    """
+    request = {"kind": kind, "data": payload, "vehicle": _vehicle_fingerprint(vehicle)}
+    if HAS_ORJSON:
+        canonical = orjson.dumps(request, option=orjson.OPT_SORT_KEYS, default=str)
+    else:
+        canonical = json.dumps(request, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.blake2b(canonical, digest_size=16).hexdigest()
+
+
+def _prompt_cache_key(prompt: str, system: Optional[str]) -> str:
+    """
+    Compute the cache key of a free-form AI request from its prompts.
+    
+    Args:
+        prompt: The prompt
+        system: Optional system prompt
+        
+    Returns:
+        Hex digest identifying the request
+    """
+    canonical = f"prompt\0{system or ''}\0{prompt}".encode('utf-8')
+    return hashlib.blake2b(canonical, digest_size=16).hexdigest()
+
+
+def _dtc_cache_key(dtcs: List[Dict], vehicle: VehicleInfo) -> str:
+    """
+    Compute the cache key for a DTC analysis.
+    
+    Args:
+        dtcs: List of DTC dictionaries
+        vehicle: Vehicle information
+        
+    Returns:
+        Hex digest identifying the request
+    """
+    return _cache_key(
+        "dtc",
+        sorted((dtc.get('code', ''), dtc.get('type', 'stored')) for dtc in dtcs),
+        vehicle
+    )
+
+
+def _sensor_cache_key(frame: SensorFrame, vehicle: VehicleInfo) -> str:
+    """
+    Compute the cache key for a sensor data analysis.
+    
+    Readings are keyed on their exact values; the cached analysis echoes them
+    back and a small change can cross an anomaly threshold.
+    
+    Args:
+        frame: Sensor readings
+        vehicle: Vehicle information
+        
+    Returns:
+        Hex digest identifying the request
+    """
+    readings = sorted(zip(frame.keys, frame.values, frame.units))
+    return _cache_key("sensor", readings, vehicle)
+
+
+def _output_tokens(base: int, per_item: int, count: int) -> int:
+    """
+    Compute the output token limit for a request about count codes or readings.
+    
+    Args:
+        base: Allowance for the fixed parts of the response
+        per_item: Allowance per code or reading
+        count: Number of codes or readings in the request
+        
+    Returns:
+        Token limit, at most MAX_OUTPUT_TOKENS
+    """
+    return min(base + per_item * count, MAX_OUTPUT_TOKENS)
+
+
+def _anthropic_request(prompt: str, system: Optional[str] = None,
+                       max_tokens: int = MAX_OUTPUT_TOKENS,
+                       response_format: Optional[Dict] = None) -> Dict:
+    """
+    Build the parameters of a Claude request.
+    
+    A response format is sent as the input schema of a tool that Claude is
+    forced to call, so the response is the tool input instead of free text.
+    
+    Args:
+        prompt: The prompt
+        system: Optional static system prompt, marked for prompt caching
+        max_tokens: Maximum number of tokens to generate
+        response_format: Optional structured output format built by _json_schema_format
+        
+    Returns:
+        Keyword arguments for messages.create or messages.stream
+    """
+    request = {
+        # the newest Anthropic model is "claude-3-5-sonnet-20241022" which was released October 22, 2024
+        "model": "claude-3-5-sonnet-20241022",
+        "max_tokens": max_tokens,
+        "temperature": TEMPERATURE,
+        "messages": [
+            {"role": "user", "content": prompt}
+        ]
+    }
+    if system:
+        request["system"] = _cached_system(system)
+    if response_format:
+        tool = response_format["json_schema"]
+        request["tools"] = [{"name": tool["name"], "input_schema": tool["schema"]}]
+        request["tool_choice"] = {"type": "tool", "name": tool["name"]}
+    return request
+
+
 class DiagnosticAI:
     """
     Class that provides AI-enhanced diagnostics using OpenAI and/or Anthropic.
     """
     
-    def __init__(self, use_openai: bool = False, use_anthropic: bool = True):
+    # DTC prefixes that often indicate more serious issues
+    _CRITICAL_PREFIXES = frozenset({'P0', 'P2'})
+    
+    def __init__(self, use_openai: bool = False, use_anthropic: bool = True,
+                 request_timeout: float = REQUEST_TIMEOUT):
         """
         Initialize the DiagnosticAI.
         
         Args:
             use_openai: Whether to use OpenAI for diagnostics
             use_anthropic: Whether to use Anthropic for diagnostics
+            request_timeout: Timeout in seconds for each read of an AI response
         """
         self.use_openai = use_openai
         self.use_anthropic = use_anthropic
+        self.request_timeout = request_timeout
+        self._timeout = _request_timeout(request_timeout)
         self.openai_client = None
         self.anthropic_client = None
         
@@ -35,8 +1409,7 @@ class DiagnosticAI:
             self.openai_key = os.environ.get('OPENAI_API_KEY')
             if self.openai_key:
                 try:
-                    from openai import OpenAI
-                    self.openai_client = OpenAI(api_key=self.openai_key)
+                    self.openai_client = _shared_client("OpenAI", self.openai_key)
                     logger.info("OpenAI client initialized successfully")
                 except Exception as e:
                     logger.error(f"Failed to initialize OpenAI client: {e}")
@@ -49,9 +1422,7 @@ class DiagnosticAI:
             self.anthropic_key = os.environ.get('ANTHROPIC_API_KEY')
             if self.anthropic_key:
                 try:
-                    import anthropic
-                    from anthropic import Anthropic
-                    self.anthropic_client = Anthropic(api_key=self.anthropic_key)
+                    self.anthropic_client = _shared_client("Anthropic", self.anthropic_key)
                     logger.info("Anthropic client initialized successfully")
                 except Exception as e:
                     logger.error(f"Failed to initialize Anthropic client: {e}")
@@ -63,138 +1434,528 @@ class DiagnosticAI:
         if not self.use_openai and not self.use_anthropic:
             logger.warning("No AI service enabled. AI diagnostics will not be available.")
     
-    def analyze_dtcs(self, dtcs: List[Dict], vehicle_info: Dict) -> Dict:
+    def get_session(self, vehicle_info: Union[VehicleInfo, Dict]) -> 'DiagnosticSession':
+        """
+        Start a diagnostic session for one vehicle.
+        
+        Args:
+            vehicle_info: VehicleInfo or dictionary with vehicle information
+            
+        Returns:
+            DiagnosticSession that reuses the normalized vehicle for every request
+        """
+        return DiagnosticSession(self, VehicleInfo.from_dict(vehicle_info))
+    
+    def analyze_dtcs(self, dtcs: List[Dict], vehicle_info: Union[VehicleInfo, Dict]) -> Dict:
         """
         Analyze Diagnostic Trouble Codes (DTCs) and provide repair recommendations.
         
         Args:
             dtcs: List of DTC dictionaries with code, type, and description
-            vehicle_info: Dictionary with vehicle information
+            vehicle_info: VehicleInfo or dictionary with vehicle information
             
         Returns:
             Dictionary with analysis, recommendations, and severity
         """
+        vehicle = VehicleInfo.from_dict(vehicle_info)
+        cache_key = _dtc_cache_key(dtcs, vehicle)
+        cached = _response_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Returning cached DTC analysis")
+            return cached
+        
         # Generate the prompt for analysis
-        prompt = self._generate_dtc_analysis_prompt(dtcs, vehicle_info)
+        prompt = self._generate_dtc_analysis_prompt(dtcs, vehicle)
+        max_tokens = _output_tokens(DTC_BASE_TOKENS, DTC_TOKENS_PER_CODE, len(dtcs))
         
-        # Try to analyze with Anthropic first, then with OpenAI, then fall back to basic analysis
-        if self.use_anthropic:
-            try:
-                analysis = self._analyze_with_anthropic(prompt)
-                if analysis:
-                    logger.info("Successfully analyzed DTCs with Anthropic")
-                    return analysis
-            except Exception as e:
-                logger.error(f"Error analyzing DTCs with Anthropic: {e}")
+        # Race the enabled AI providers, sharing the race with identical requests
+        # in flight, then fall back to basic analysis
+        provider, analysis = self._shared_provider_result(
+            cache_key,
+            lambda: self._analyze_with_anthropic(prompt, _DTC_SYSTEM_PROMPT, max_tokens, _DTC_RESPONSE_FORMAT),
+            lambda: self._analyze_with_openai(prompt, _DTC_SYSTEM_PROMPT, max_tokens, _DTC_RESPONSE_FORMAT),
+            _DTC_ANALYSIS_DEFAULTS
+        )
+        if analysis:
+            logger.info(f"Successfully analyzed DTCs with {provider}")
+            return analysis
+        
+        # Fallback to basic analysis without AI
+        logger.warning("Falling back to basic DTC analysis without AI")
+        return self._basic_dtc_analysis(dtcs)
+    
+    def submit_dtc_analysis(self, dtcs: List[Dict], vehicle_info: Union[VehicleInfo, Dict]) -> Future:
+        """
+        Start analyzing DTCs in the background.
+        
+        The request handler can return immediately and collect the analysis
+        later, instead of holding its thread for the whole AI round trip.
+        Background analyses share the per-provider concurrency limits with
+        all other AI calls.
+        
+        Args:
+            dtcs: List of DTC dictionaries with code, type, and description
+            vehicle_info: VehicleInfo or dictionary with vehicle information
+            
+        Returns:
+            Future whose result is the analysis dictionary
+        """
+        return _background_executor.submit(self.analyze_dtcs, dtcs, vehicle_info)
+    
+    def analyze_dtcs_stream(self, dtcs: List[Dict],
+                            vehicle_info: Union[VehicleInfo, Dict]) -> Iterator[Tuple[str, Dict]]:
+        """
+        Analyze DTCs, yielding each diagnosis as soon as the AI has generated it.
+        
+        The response is streamed from the first enabled provider and scanned
+        as it arrives, so the first diagnoses can be shown while the repair
+        recommendations are still being generated. If the stream fails, the
+        other enabled provider is tried before the basic analysis. The
+        provider's concurrency slot is only held while reading from it, so a
+        slow consumer does not hold up other calls to the provider.
+        
+        Args:
+            dtcs: List of DTC dictionaries with code, type, and description
+            vehicle_info: VehicleInfo or dictionary with vehicle information
+            
+        Yields:
+            ("severity", severity) and ("diagnosis", diagnosis) for each
+            diagnosis as soon as they complete, ("reset", None) when a stream
+            fails after some of these were yielded and they are superseded,
+            then ("analysis", analysis) with the complete analysis
+        """
+        vehicle = VehicleInfo.from_dict(vehicle_info)
+        cache_key = _dtc_cache_key(dtcs, vehicle)
+        cached = _response_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Returning cached DTC analysis")
+            yield "analysis", cached
+            return
         
+        providers = []
+        if self.use_anthropic:
+            providers.append(("Anthropic", self._stream_anthropic_text))
         if self.use_openai:
+            providers.append(("OpenAI", self._stream_openai_text))
+        
+        prompt = None
+        max_tokens = _output_tokens(DTC_BASE_TOKENS, DTC_TOKENS_PER_CODE, len(dtcs))
+        for provider, stream_text in providers:
+            if not _breakers[provider].allow():
+                continue
+            if prompt is None:
+                prompt = self._generate_dtc_analysis_prompt(dtcs, vehicle)
+            
+            scanner = _ResponseScanner("diagnoses", ("severity",))
+            chunks = []
+            partial = False
+            stream = stream_text(prompt, _DTC_SYSTEM_PROMPT, max_tokens, response_format=_DTC_RESPONSE_FORMAT)
             try:
-                analysis = self._analyze_with_openai(prompt)
-                if analysis:
-                    logger.info("Successfully analyzed DTCs with OpenAI")
-                    return analysis
+                while True:
+                    with _provider_slots[provider]:
+                        text = next(stream, None)
+                    if text is None:
+                        break
+                    chunks.append(text)
+                    for key, value in scanner.feed(text):
+                        partial = True
+                        if key == "severity":
+                            yield "severity", _normalize_severity(value, _DTC_ANALYSIS_DEFAULTS["severity"])
+                        else:
+                            yield "diagnosis", value
             except Exception as e:
-                logger.error(f"Error analyzing DTCs with OpenAI: {e}")
+                logger.error(f"Error streaming DTC analysis from {provider}: {e}")
+            finally:
+                stream.close()
+            
+            analysis = _parse_ai_json("".join(chunks), provider) if scanner.complete else None
+            analysis = _normalize_response(analysis, _DTC_ANALYSIS_DEFAULTS)
+            if analysis:
+                _breakers[provider].record_success()
+                logger.info(f"Successfully analyzed DTCs with {provider}")
+                _response_cache.set(cache_key, analysis)
+                yield "analysis", analysis
+                return
+            _breakers[provider].record_failure()
+            if partial:
+                yield "reset", None
         
         # Fallback to basic analysis without AI
         logger.warning("Falling back to basic DTC analysis without AI")
-        return self._basic_dtc_analysis(dtcs)
+        yield "analysis", self._basic_dtc_analysis(dtcs)
     
-    def _generate_dtc_analysis_prompt(self, dtcs: List[Dict], vehicle_info: Dict) -> str:
+    def analyze_dtcs_batch(self, items: List[Tuple[List[Dict], Union[VehicleInfo, Dict]]],
+                           batch_size: int = BATCH_SIZE) -> List[Dict]:
         """
-        Generate a prompt for the AI to analyze DTCs.
+        Analyze the DTCs of several vehicles with as few AI requests as possible.
+        
+        Cases are sent in groups of up to batch_size per prompt and the AI
+        returns one analysis per case, which saves a round trip and the
+        repeated instructions for every additional vehicle. The groups are
+        sent concurrently. Cached cases are not sent again.
         
         Args:
-            dtcs: List of DTCs
-            vehicle_info: Vehicle information
+            items: List of (dtcs, vehicle_info) tuples
+            batch_size: Maximum number of cases per AI request
             
         Returns:
-            Prompt string for AI analysis
+            List of analysis dictionaries, in the same order as items
         """
-        # Format vehicle info
-        year = vehicle_info.get('year', 'Unknown')
-        make = vehicle_info.get('make', 'Unknown')
-        model = vehicle_info.get('model', 'Unknown')
-        mileage = vehicle_info.get('mileage', 'Unknown')
-        vin = vehicle_info.get('vin', 'Unknown')
+        items = [(dtcs, VehicleInfo.from_dict(vehicle_info)) for dtcs, vehicle_info in items]
+        results: List[Optional[Dict]] = [None] * len(items)
+        cache_keys = []
+        pending = []
+        for index, (dtcs, vehicle) in enumerate(items):
+            cache_key = _dtc_cache_key(dtcs, vehicle)
+            cache_keys.append(cache_key)
+            results[index] = _response_cache.get(cache_key)
+            if results[index] is None:
+                pending.append(index)
         
-        # Format DTCs
-        dtc_details = []
-        for dtc in dtcs:
-            dtc_details.append(f"- {dtc.get('code')}: {dtc.get('description', 'Unknown description')} (Type: {dtc.get('type', 'stored')})")
+        if len(pending) > 1:
+            groups = [pending[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+            group_analyses = _batch_executor.map(
+                lambda group: self._analyze_dtc_group([items[index] for index in group]), groups
+            )
+            for group, analyses in zip(groups, group_analyses):
+                for index, analysis in zip(group, analyses or ()):
+                    if analysis:
+                        _response_cache.set(cache_keys[index], analysis)
+                        results[index] = analysis
         
-        dtc_list = "\n".join(dtc_details) if dtc_details else "No DTCs provided"
+        # Analyze whatever the batch could not provide one case at a time
+        for index, result in enumerate(results):
+            if result is None:
+                dtcs, vehicle = items[index]
+                results[index] = self.analyze_dtcs(dtcs, vehicle)
         
-        # Generate the prompt
-        prompt = f"""You are an expert automotive diagnostic assistant. You're analyzing DTCs (Diagnostic Trouble Codes) for a vehicle and will provide a detailed analysis.
-
-Vehicle Information:
-- Year: {year}
-- Make: {make}
-- Model: {model}
-- Mileage: {mileage}
-- VIN: {vin}
-
-Diagnostic Trouble Codes:
-{dtc_list}
+        return results
+    
+    def _analyze_dtc_group(self, items: List[Tuple[List[Dict], VehicleInfo]]) -> Optional[List[Optional[Dict]]]:
+        """
+        Analyze one group of batched DTC cases with a single AI request.
+        
+        Args:
+            items: List of (dtcs, vehicle) tuples
+            
+        Returns:
+            List with the analysis of each case, or None for a case whose
+            analysis is unusable, or None if the request failed
+        """
+        prompt = self._generate_dtc_batch_prompt(items)
+        max_tokens = min(max(len(items) * BATCH_TOKENS_PER_CASE, MAX_OUTPUT_TOKENS), MODEL_MAX_OUTPUT_TOKENS)
+        provider, batch = self._first_provider_result(
+            lambda: self._analyze_with_anthropic(prompt, _DTC_SYSTEM_PROMPT, max_tokens, _DTC_BATCH_RESPONSE_FORMAT),
+            lambda: self._analyze_with_openai(prompt, _DTC_SYSTEM_PROMPT, max_tokens, _DTC_BATCH_RESPONSE_FORMAT)
+        )
+        analyses = batch.get('results') if isinstance(batch, dict) else None
+        if isinstance(analyses, list) and len(analyses) == len(items):
+            logger.info(f"Successfully analyzed {len(items)} DTC cases with {provider}")
+            return [_normalize_response(analysis, _DTC_ANALYSIS_DEFAULTS) for analysis in analyses]
+        
+        if batch:
+            logger.error("Batch DTC analysis returned an unexpected number of results")
+        return None
+    
+    def submit_dtc_batch_job(self, items: List[Tuple[List[Dict], Union[VehicleInfo, Dict]]]) -> Optional[str]:
+        """
+        Queue the DTC analyses of several vehicles on Anthropic's Message Batches API.
+        
+        Batched requests cost half as much as interactive ones but can take up
+        to 24 hours, so this is meant for background jobs such as fleet
+        reports. Fetch the results with collect_dtc_batch_job.
+        
+        Args:
+            items: List of (dtcs, vehicle_info) tuples
+            
+        Returns:
+            ID of the queued batch, or None if it could not be submitted
+        """
+        if not self.anthropic_client:
+            logger.error("Anthropic client not initialized")
+            return None
+        
+        requests = [
+            {
+                "custom_id": f"case-{index}",
+                "params": _anthropic_request(
+                    self._generate_dtc_analysis_prompt(dtcs, VehicleInfo.from_dict(vehicle_info)),
+                    _DTC_SYSTEM_PROMPT,
+                    _output_tokens(DTC_BASE_TOKENS, DTC_TOKENS_PER_CODE, len(dtcs)),
+                    _DTC_RESPONSE_FORMAT
+                )
+            }
+            for index, (dtcs, vehicle_info) in enumerate(items)
+        ]
+        try:
+            batch = self.anthropic_client.messages.batches.create(requests=requests)
+        except Exception as e:
+            logger.error(f"Error submitting DTC batch to Anthropic: {e}")
+            return None
+        
+        logger.info(f"Queued {len(requests)} DTC cases as Anthropic batch {batch.id}")
+        return batch.id
+    
+    def collect_dtc_batch_job(self, batch_id: str,
+                              items: List[Tuple[List[Dict], Union[VehicleInfo, Dict]]]) -> Optional[List[Dict]]:
+        """
+        Fetch the results of a batch queued with submit_dtc_batch_job.
+        
+        Cases whose request failed get the basic analysis. Successful
+        analyses are cached, so later interactive requests for the same
+        vehicle and codes are answered immediately.
+        
+        Args:
+            batch_id: ID returned by submit_dtc_batch_job
+            items: The items the batch was submitted with
+            
+        Returns:
+            List of analysis dictionaries in the same order as items, or None
+            if the batch has not finished yet or could not be fetched
+        """
+        if not self.anthropic_client:
+            logger.error("Anthropic client not initialized")
+            return None
+        
+        try:
+            batch = self.anthropic_client.messages.batches.retrieve(batch_id)
+            if batch.processing_status != "ended":
+                return None
+            analyses = {}
+            for entry in self.anthropic_client.messages.batches.results(batch_id):
+                if entry.result.type == "succeeded":
+                    # The analysis is the input of the forced tool call
+                    analysis = next(
+                        (block.input for block in entry.result.message.content if block.type == "tool_use"), None
+                    )
+                    analyses[entry.custom_id] = _normalize_response(analysis, _DTC_ANALYSIS_DEFAULTS)
+        except Exception as e:
+            logger.error(f"Error fetching Anthropic batch {batch_id}: {e}")
+            return None
+        
+        results = []
+        for index, (dtcs, vehicle_info) in enumerate(items):
+            analysis = analyses.get(f"case-{index}")
+            if analysis:
+                _response_cache.set(_dtc_cache_key(dtcs, VehicleInfo.from_dict(vehicle_info)), analysis)
+            else:
+                logger.warning(f"No AI analysis for case {index} of batch {batch_id}, using basic analysis")
+                analysis = self._basic_dtc_analysis(dtcs)
+            results.append(analysis)
+        
+        return results
+    
+    def _generate_dtc_batch_prompt(self, items: List[Tuple[List[Dict], VehicleInfo]]) -> str:
+        """
+        Generate a prompt for the AI to analyze the DTCs of several vehicles.
+        
+        Args:
+            items: List of (dtcs, vehicle) tuples
+            
+        Returns:
+            Prompt string for AI analysis
+        """
+        # Each case is the single-vehicle prompt under its own heading
+        case_list = "\n\n".join(
+            f"### Case {index}\n{self._generate_dtc_analysis_prompt(dtcs, vehicle)}"
+            for index, (dtcs, vehicle) in enumerate(items, 1)
+        )
+        
+        return f"""The following {len(items)} cases are separate vehicles. Provide a detailed analysis for each one.
 
-Based on these DTCs and the vehicle information, please provide:
-1. A detailed analysis of the likely problems in the vehicle
-2. The severity of the issues (critical, high, medium, low, or none)
-3. Recommended repair options, including DIY fixes where possible
-4. Estimated costs for repairs
-5. Any safety warnings the owner should be aware of
+{case_list}
 
-Format your response as a JSON object with the following structure:
-{
-  "diagnoses": [
-    {
-      "name": "Short name of the diagnosis",
-      "description": "Detailed description of the problem",
-      "confidence": 0.0-1.0,
-      "severity": "critical|high|medium|low|none"
-    }
-  ],
-  "severity": "critical|high|medium|low|none",
-  "diy_repairs": [
-    {
-      "issue_name": "Name of the issue being repaired",
-      "repair_name": "Name of the repair procedure",
-      "description": "Detailed description of the repair",
-      "difficulty": 1-5,
-      "estimated_cost": "$XX-$YY",
-      "steps": ["Step 1", "Step 2", "..."]
-    }
-  ],
-  "professional_repairs": [
-    {
-      "issue_name": "Name of the issue being repaired",
-      "repair_name": "Name of the repair procedure",
-      "description": "Detailed description of the repair",
-      "estimated_cost": "$XX-$YY"
-    }
-  ],
-  "safety_warnings": [
-    {
-      "text": "Warning text",
-      "issue_name": "Related issue"
-    }
-  ]
-}
+Format your response as a JSON object of the form {{"results": [...]}}, where "results" contains exactly {len(items)} objects, one per case and in case order, each with the structure described above."""
 
-Provide only the JSON response, with no additional text before or after.
-"""
-        return prompt
+    def _shared_provider_result(self, cache_key: str, anthropic_call: Callable[[], Optional[Dict]],
+                                openai_call: Callable[[], Optional[Dict]], defaults: Dict[str, Any],
+                                cache_provider: bool = False) -> Tuple[Optional[str], Optional[Dict]]:
+        """
+        Race the enabled AI providers once for all identical requests in flight.
+        
+        The response is normalized and written to the response cache before
+        the request stops being in flight, so an identical request arriving
+        in between finds it in the cache instead of calling a provider again.
+        
+        Args:
+            cache_key: Cache key of the request
+            anthropic_call: Function that calls Anthropic
+            openai_call: Function that calls OpenAI
+            defaults: Default value of each top-level field of the response
+            cache_provider: Whether to cache the provider name with the result,
+                as a (provider, result) tuple
+            
+        Returns:
+            Tuple of provider name and normalized result, or (None, None) if all failed
+        """
+        def compute() -> Tuple[Optional[str], Optional[Dict]]:
+            provider, result = self._first_provider_result(anthropic_call, openai_call)
+            result = _normalize_response(result, defaults)
+            if result is None:
+                return None, None
+            _response_cache.set(cache_key, (provider, result) if cache_provider else result)
+            return provider, result
+        
+        return _single_flight(cache_key, compute)
     
-    def _analyze_with_anthropic(self, prompt: str) -> Optional[Dict]:
+    def _first_provider_result(self, anthropic_call: Callable[[], Optional[Dict]],
+                               openai_call: Callable[[], Optional[Dict]]) -> Tuple[Optional[str], Optional[Dict]]:
         """
-        Use Anthropic's Claude to analyze the diagnostic data.
+        Call the enabled AI providers and return the first usable result.
+        
+        When both providers are enabled they are called concurrently, so the
+        response time is that of the faster provider and a failing provider
+        no longer delays the other one. Providers whose circuit breaker is
+        open are skipped.
+        
+        Args:
+            anthropic_call: Function that calls Anthropic
+            openai_call: Function that calls OpenAI
+            
+        Returns:
+            Tuple of provider name and result, or (None, None) if all failed
+        """
+        calls = []
+        if self.use_anthropic and _breakers["Anthropic"].allow():
+            calls.append(("Anthropic", anthropic_call))
+        if self.use_openai and _breakers["OpenAI"].allow():
+            calls.append(("OpenAI", openai_call))
+        
+        if not calls:
+            return None, None
+        
+        if len(calls) == 1:
+            provider, call = calls[0]
+            return provider, _call_provider(provider, call)
+        
+        cancelled = threading.Event()
+        futures = {
+            _executor.submit(_call_provider, provider, call, cancelled): provider
+            for provider, call in calls
+        }
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                if result:
+                    return futures[future], result
+        finally:
+            # Drop calls that have not started yet and stop reading the streams of running ones
+            cancelled.set()
+            for future in futures:
+                future.cancel()
+        
+        return None, None
+    
+    def _generate_dtc_analysis_prompt(self, dtcs: List[Dict], vehicle: VehicleInfo) -> str:
+        """
+        Generate a prompt for the AI to analyze DTCs.
+        
+        Args:
+            dtcs: List of DTCs
+            vehicle: Vehicle information
+            
+        Returns:
+            Prompt string for AI analysis
+        """
+        # Format DTCs
+        dtc_list = "\n".join(
+            f"- {dtc.get('code')}: {dtc.get('description', 'Unknown description')} (Type: {dtc.get('type', 'stored')})"
+            for dtc in dtcs
+        ) or "No DTCs provided"
+        
+        return _DTC_PROMPT_TEMPLATE.format_map({
+            "vehicle_block": vehicle.prompt_block,
+            "dtc_list": dtc_list
+        })
+    
+    def _stream_anthropic_text(self, prompt: str, system: Optional[str] = None,
+                               max_tokens: int = MAX_OUTPUT_TOKENS,
+                               response_format: Optional[Dict] = None) -> Iterator[str]:
+        """
+        Stream the text of Claude's response to a prompt.
+        
+        Args:
+            prompt: The analysis prompt
+            system: Optional static system prompt, marked for prompt caching
+            max_tokens: Maximum number of tokens to generate
+            response_format: Optional structured output format, in which case
+                the JSON input of the forced tool call is streamed instead of text
+            
+        Yields:
+            Response text chunks as they are generated
+        """
+        request = _anthropic_request(prompt, system, max_tokens, response_format)
+        request["timeout"] = self._timeout
+        
+        with self.anthropic_client.messages.stream(**request) as stream:
+            for event in stream:
+                if event.type == "text":
+                    yield event.text
+                elif event.type == "input_json":
+                    yield event.partial_json
+                elif event.type == "message_start":
+                    # Log token usage so the output limits can be tuned from production data
+                    usage = event.message.usage
+                    logger.info(
+                        f"Anthropic request: {usage.input_tokens} uncached input tokens, "
+                        f"{usage.cache_read_input_tokens or 0} read from and "
+                        f"{usage.cache_creation_input_tokens or 0} written to the prompt cache"
+                    )
+                elif event.type == "message_delta":
+                    logger.info(
+                        f"Anthropic response: {event.usage.output_tokens} output tokens, "
+                        f"stop reason {event.delta.stop_reason}"
+                    )
+    
+    def _stream_openai_text(self, prompt: str, system: Optional[str] = None,
+                            max_tokens: int = MAX_OUTPUT_TOKENS,
+                            response_format: Optional[Dict] = None) -> Iterator[str]:
+        """
+        Stream the text of GPT's response to a prompt.
         
         Args:
             prompt: The analysis prompt
+            system: Optional system prompt
+            max_tokens: Maximum number of tokens to generate
+            response_format: Optional structured output format, plain JSON mode if omitted
+            
+        Yields:
+            Response text chunks as they are generated
+        """
+        # the newest OpenAI model is "gpt-4o" which was released May 13, 2024
+        with self.openai_client.chat.completions.create(
+            model="gpt-4o",
+            messages=[
+                {"role": "system", "content": system or "You are an expert automotive diagnostic assistant."},
+                {"role": "user", "content": prompt}
+            ],
+            response_format=response_format or {"type": "json_object"},
+            max_tokens=max_tokens,
+            temperature=TEMPERATURE,
+            stream=True,
+            timeout=self._timeout
+        ) as stream:
+            for chunk in stream:
+                if chunk.choices:
+                    content = chunk.choices[0].delta.content
+                    if content:
+                        yield content
+    
+    def _call_anthropic(self, prompt: str, system: Optional[str] = None,
+                        task: str = "analysis", max_tokens: int = MAX_OUTPUT_TOKENS,
+                        response_format: Optional[Dict] = None) -> Optional[Dict]:
+        """
+        Send a prompt to Anthropic's Claude and parse the JSON response.
+        
+        Args:
+            prompt: The prompt
+            system: Optional static system prompt, marked for prompt caching
+            task: Description of the request, for logging
+            max_tokens: Maximum number of tokens to generate
+            response_format: Optional structured output format, enforced with forced tool use
             
         Returns:
-            Analysis results as a dictionary, or None if failed
+            Parsed response as a dictionary, or None if failed
         """
         try:
             # Use the pre-initialized client
@@ -202,53 +1963,42 @@ Provide only the JSON response, with no additional text before or after.
                 logger.error("Anthropic client not initialized")
                 return None
             
-            client = self.anthropic_client
-            
-            # Call Claude to analyze the data
-            # the newest Anthropic model is "claude-3-5-sonnet-20241022" which was released October 22, 2024
-            response = client.messages.create(
-                model="claude-3-5-sonnet-20241022",
-                max_tokens=4000,
-                messages=[
-                    {"role": "user", "content": prompt}
-                ]
+            # Collect the streamed chunks and join them once at the end
+            response_text = _with_retries(
+                "Anthropic", lambda: _collect_stream(
+                    self._stream_anthropic_text(prompt, system, max_tokens, response_format)
+                )
             )
-            
-            # Extract the JSON response
-            if response.content and len(response.content) > 0:
-                content_block = response.content[0]
-                if hasattr(content_block, 'text'):
-                    response_text = content_block.text
-                    # Try to parse the JSON response
-                    try:
-                        return json.loads(response_text)
-                    except json.JSONDecodeError as e:
-                        logger.error(f"Error parsing Anthropic JSON response: {e}")
-                        # Try to extract just the JSON part
-                        import re
-                        json_match = re.search(r'({[\s\S]*})', response_text)
-                        if json_match:
-                            try:
-                                return json.loads(json_match.group(1))
-                            except json.JSONDecodeError:
-                                logger.error("Failed to parse extracted JSON from Anthropic response")
+            if response_text:
+                result = _parse_ai_json(response_text, "Anthropic")
+                if result is not None:
+                    return result
             
             logger.error("Failed to get valid response from Anthropic")
             return None
-            
+        
+        except _CallCancelled:
+            logger.debug("Anthropic call cancelled, another provider answered first")
+            return None
         except Exception as e:
-            logger.error(f"Error using Anthropic for analysis: {e}")
+            logger.error(f"Error using Anthropic for {task}: {e}")
             return None
     
-    def _analyze_with_openai(self, prompt: str) -> Optional[Dict]:
+    def _call_openai(self, prompt: str, system: Optional[str] = None,
+                     task: str = "analysis", max_tokens: int = MAX_OUTPUT_TOKENS,
+                     response_format: Optional[Dict] = None) -> Optional[Dict]:
         """
-        Use OpenAI's GPT models to analyze the diagnostic data.
+        Send a prompt to OpenAI's GPT models and parse the JSON response.
         
         Args:
-            prompt: The analysis prompt
+            prompt: The prompt
+            system: Optional system prompt
+            task: Description of the request, for logging
+            max_tokens: Maximum number of tokens to generate
+            response_format: Optional structured output format, plain JSON mode if omitted
             
         Returns:
-            Analysis results as a dictionary, or None if failed
+            Parsed response as a dictionary, or None if failed
         """
         try:
             # Use the pre-initialized client
@@ -256,37 +2006,61 @@ Provide only the JSON response, with no additional text before or after.
                 logger.error("OpenAI client not initialized")
                 return None
             
-            client = self.openai_client
-            
-            # Call OpenAI to analyze the data
-            # the newest OpenAI model is "gpt-4o" which was released May 13, 2024
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are an expert automotive diagnostic assistant."},
-                    {"role": "user", "content": prompt}
-                ],
-                response_format={"type": "json_object"}
+            # Collect the streamed chunks and join them once at the end
+            content = _with_retries(
+                "OpenAI", lambda: _collect_stream(
+                    self._stream_openai_text(prompt, system, max_tokens, response_format)
+                )
             )
-            
-            # Extract the JSON response
-            if response.choices and len(response.choices) > 0:
-                message = response.choices[0].message
-                content = message.content
-                
-                if content:
-                    try:
-                        return json.loads(content)
-                    except json.JSONDecodeError as e:
-                        logger.error(f"Error parsing OpenAI JSON response: {e}")
+            if content:
+                result = _parse_ai_json(content, "OpenAI")
+                if result is not None:
+                    return result
             
             logger.error("Failed to get valid response from OpenAI")
             return None
-            
+        
+        except _CallCancelled:
+            logger.debug("OpenAI call cancelled, another provider answered first")
+            return None
         except Exception as e:
-            logger.error(f"Error using OpenAI for analysis: {e}")
+            logger.error(f"Error using OpenAI for {task}: {e}")
             return None
     
+    def _analyze_with_anthropic(self, prompt: str, system: Optional[str] = None,
+                                max_tokens: int = MAX_OUTPUT_TOKENS,
+                                response_format: Optional[Dict] = None) -> Optional[Dict]:
+        """
+        Use Anthropic's Claude to analyze the diagnostic data.
+        
+        Args:
+            prompt: The analysis prompt
+            system: Optional static system prompt, marked for prompt caching
+            max_tokens: Maximum number of tokens to generate
+            response_format: Optional structured output format, free-form JSON if omitted
+            
+        Returns:
+            Analysis results as a dictionary, or None if failed
+        """
+        return self._call_anthropic(prompt, system, "analysis", max_tokens, response_format)
+    
+    def _analyze_with_openai(self, prompt: str, system: Optional[str] = None,
+                             max_tokens: int = MAX_OUTPUT_TOKENS,
+                             response_format: Optional[Dict] = None) -> Optional[Dict]:
+        """
+        Use OpenAI's GPT models to analyze the diagnostic data.
+        
+        Args:
+            prompt: The analysis prompt
+            system: Optional system prompt
+            max_tokens: Maximum number of tokens to generate
+            response_format: Optional structured output format, plain JSON mode if omitted
+            
+        Returns:
+            Analysis results as a dictionary, or None if failed
+        """
+        return self._call_openai(prompt, system, "analysis", max_tokens, response_format)
+    
     def _basic_dtc_analysis(self, dtcs: List[Dict]) -> Dict:
         """
         Provide a basic analysis of DTCs without using AI.
@@ -298,16 +2072,11 @@ Provide only the JSON response, with no additional text before or after.
         Returns:
             Basic analysis as a dictionary
         """
-        # Basic severity assessment
-        severity = "medium"  # Default severity
-        
-        # Look for known critical codes
-        critical_prefixes = ['P0', 'P2']  # These are often more serious
-        for dtc in dtcs:
-            code = dtc.get('code', '')
-            if any(code.startswith(prefix) for prefix in critical_prefixes):
-                severity = "high"
-                break
+        # Basic severity assessment: high if any code has a critical prefix, medium otherwise
+        if any(dtc.get('code', '')[:2] in self._CRITICAL_PREFIXES for dtc in dtcs):
+            severity = "high"
+        else:
+            severity = "medium"
         
         # Create diagnoses
         diagnoses = []
@@ -344,125 +2113,75 @@ Provide only the JSON response, with no additional text before or after.
             "safety_warnings": safety_warnings
         }
     
-    def analyze_sensor_data(self, sensor_data: Dict, vehicle_info: Dict) -> Dict:
+    def analyze_sensor_data(self, sensor_data: Union[SensorFrame, Dict],
+                            vehicle_info: Union[VehicleInfo, Dict]) -> Dict:
         """
         Analyze real-time sensor data and provide insights.
         
         Args:
-            sensor_data: Dictionary of sensor readings
-            vehicle_info: Dictionary with vehicle information
+            sensor_data: SensorFrame or dictionary of sensor readings
+            vehicle_info: VehicleInfo or dictionary with vehicle information
             
         Returns:
             Dictionary with analysis and recommendations
         """
-        # Generate the prompt for analysis
-        prompt = self._generate_sensor_analysis_prompt(sensor_data, vehicle_info)
+        frame = SensorFrame.from_dict(sensor_data)
+        vehicle = VehicleInfo.from_dict(vehicle_info)
+        cache_key = _sensor_cache_key(frame, vehicle)
+        cached = _response_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Returning cached sensor data analysis")
+            return cached
         
-        # Try to analyze with Anthropic first, then with OpenAI, then fall back to basic analysis
-        if self.use_anthropic:
-            try:
-                analysis = self._analyze_with_anthropic(prompt)
-                if analysis:
-                    logger.info("Successfully analyzed sensor data with Anthropic")
-                    return analysis
-            except Exception as e:
-                logger.error(f"Error analyzing sensor data with Anthropic: {e}")
+        # Generate the prompt for analysis
+        prompt = self._generate_sensor_analysis_prompt(frame, vehicle)
+        max_tokens = _output_tokens(SENSOR_BASE_TOKENS, SENSOR_TOKENS_PER_READING, len(frame.keys))
         
-        if self.use_openai:
-            try:
-                analysis = self._analyze_with_openai(prompt)
-                if analysis:
-                    logger.info("Successfully analyzed sensor data with OpenAI")
-                    return analysis
-            except Exception as e:
-                logger.error(f"Error analyzing sensor data with OpenAI: {e}")
+        # Race the enabled AI providers, sharing the race with identical requests
+        # in flight, then fall back to basic analysis
+        provider, analysis = self._shared_provider_result(
+            cache_key,
+            lambda: self._analyze_with_anthropic(prompt, _SENSOR_SYSTEM_PROMPT, max_tokens, _SENSOR_RESPONSE_FORMAT),
+            lambda: self._analyze_with_openai(prompt, _SENSOR_SYSTEM_PROMPT, max_tokens, _SENSOR_RESPONSE_FORMAT),
+            _SENSOR_ANALYSIS_DEFAULTS
+        )
+        if analysis:
+            logger.info(f"Successfully analyzed sensor data with {provider}")
+            return analysis
         
         # Fallback to basic analysis without AI
         logger.warning("Falling back to basic sensor data analysis without AI")
-        return self._basic_sensor_analysis(sensor_data)
+        return self._basic_sensor_analysis(frame)
     
-    def _generate_sensor_analysis_prompt(self, sensor_data: Dict, vehicle_info: Dict) -> str:
+    def _generate_sensor_analysis_prompt(self, frame: SensorFrame, vehicle: VehicleInfo) -> str:
         """
         Generate a prompt for the AI to analyze sensor data.
         
         Args:
-            sensor_data: Dictionary of sensor readings
-            vehicle_info: Vehicle information
+            frame: Sensor readings
+            vehicle: Vehicle information
             
         Returns:
             Prompt string for AI analysis
         """
-        # Format vehicle info
-        year = vehicle_info.get('year', 'Unknown')
-        make = vehicle_info.get('make', 'Unknown')
-        model = vehicle_info.get('model', 'Unknown')
-        mileage = vehicle_info.get('mileage', 'Unknown')
-        
         # Format sensor data
-        sensor_readings = []
-        for key, data in sensor_data.items():
-            value = data.get('value', 'Unknown')
-            unit = data.get('unit', '')
-            sensor_readings.append(f"- {key}: {value} {unit}")
-        
-        sensor_list = "\n".join(sensor_readings) if sensor_readings else "No sensor data provided"
+        sensor_list = "\n".join(
+            f"- {key}: {'Unknown' if value is None else value} {unit}"
+            for key, value, unit in zip(frame.keys, frame.values, frame.units)
+        ) or "No sensor data provided"
         
-        # Generate the prompt
-        prompt = f"""You are an expert automotive diagnostic assistant. You're analyzing live sensor data from a vehicle's OBD2 system and will provide insights.
-
-Vehicle Information:
-- Year: {year}
-- Make: {make}
-- Model: {model}
-- Mileage: {mileage}
-
-Sensor Readings:
-{sensor_list}
-
-Based on these sensor readings and the vehicle information, please provide:
-1. An analysis of whether these readings are normal or indicate potential issues
-2. Any anomalies or concerning values in the data
-3. Possible issues that might be developing based on these readings
-4. Recommended actions the owner should take
-
-Format your response as a JSON object with the following structure:
-{{
-  "analysis": "Overall analysis of the sensor data",
-  "anomalies": [
-    {{
-      "sensor": "Name of sensor with anomalous reading",
-      "reading": "The reading value",
-      "normal_range": "The normal range for this sensor",
-      "severity": "critical|high|medium|low|none",
-      "possible_causes": ["Cause 1", "Cause 2"]
-    }}
-  ],
-  "potential_issues": [
-    {{
-      "name": "Name of potential issue",
-      "description": "Description of the issue",
-      "confidence": 0.0-1.0,
-      "related_sensors": ["Sensor 1", "Sensor 2"]
-    }}
-  ],
-  "recommendations": [
-    "Recommendation 1",
-    "Recommendation 2"
-  ],
-  "severity": "critical|high|medium|low|none"
-}}
-
-Provide only the JSON response, with no additional text before or after.
-"""
-        return prompt
+        return _SENSOR_PROMPT_TEMPLATE.format_map({
+            "vehicle_block": vehicle.prompt_block,
+            "sensor_list": sensor_list
+        })
     
-    def _basic_sensor_analysis(self, sensor_data: Dict) -> Dict:
+    def _basic_sensor_analysis(self, frame: SensorFrame) -> Dict:
         """
         Provide a basic analysis of sensor data without using AI.
         This is a fallback when AI is not available.
         
         Args:
-            sensor_data: Dictionary of sensor readings
+            frame: Sensor readings
             
         Returns:
             Basic analysis as a dictionary
@@ -473,48 +2192,33 @@ Provide only the JSON response, with no additional text before or after.
         potential_issues = []
         severity = "none"
         
-        # Check engine temperature
-        if 'coolant_temp' in sensor_data:
-            temp_value = sensor_data['coolant_temp'].get('value', 0)
-            if temp_value > 100:  # Over 100°C is concerning
-                anomalies.append({
-                    "sensor": "Engine Coolant Temperature",
-                    "reading": f"{temp_value} °C",
-                    "normal_range": "80-95 °C",
-                    "severity": "high",
-                    "possible_causes": ["Low coolant level", "Faulty thermostat", "Cooling system issue"]
-                })
-                potential_issues.append({
-                    "name": "Engine Overheating",
-                    "description": "Engine temperature is higher than normal operating range",
-                    "confidence": 0.8,
-                    "related_sensors": ["coolant_temp"]
-                })
-                severity = "high"
-                analysis = "Engine temperature is higher than normal. This could indicate cooling system issues."
-        
-        # Check engine RPM
-        if 'rpm' in sensor_data:
-            rpm_value = sensor_data['rpm'].get('value', 0)
-            if rpm_value > 1000 and 'speed' in sensor_data:
-                speed_value = sensor_data['speed'].get('value', 0)
-                if speed_value < 5:  # High RPM but not moving
-                    anomalies.append({
-                        "sensor": "Engine RPM",
-                        "reading": f"{rpm_value} RPM",
-                        "normal_range": "700-900 RPM (idle)",
-                        "severity": "medium",
-                        "possible_causes": ["Vacuum leak", "Idle control issue", "Throttle body problem"]
-                    })
-                    potential_issues.append({
-                        "name": "High Idle RPM",
-                        "description": "Engine is idling at a higher than normal RPM",
-                        "confidence": 0.7,
-                        "related_sensors": ["rpm", "speed"]
-                    })
-                    if severity != "high":
-                        severity = "medium"
-                    analysis = "Engine is idling at a higher than normal RPM, which could indicate vacuum leaks or idle control issues."
+        # Check every threshold rule in a single pass over the table
+        for rule in _BASIC_SENSOR_RULES:
+            if rule["sensor"] not in frame:
+                continue
+            value = frame.value(rule["sensor"], 0)
+            if value <= rule["limit"]:
+                continue
+            max_speed = rule["max_speed"]
+            if max_speed is not None and ('speed' not in frame or frame.value('speed', 0) >= max_speed):
+                continue
+        
+            anomalies.append({
+                "sensor": rule["name"],
+                "reading": f"{value} {rule['unit']}",
+                "normal_range": rule["normal_range"],
+                "severity": rule["severity"],
+                "possible_causes": list(rule["possible_causes"])
+            })
+            potential_issues.append({
+                "name": rule["issue_name"],
+                "description": rule["issue_description"],
+                "confidence": rule["confidence"],
+                "related_sensors": list(rule["related_sensors"])
+            })
+            if _SEVERITY_RANK[rule["severity"]] > _SEVERITY_RANK[severity]:
+                severity = rule["severity"]
+            analysis = rule["analysis"]
         
         # Generate recommendations
         recommendations = ["Monitor the vehicle for any changes in performance or warning lights"]
@@ -532,77 +2236,40 @@ Provide only the JSON response, with no additional text before or after.
             "severity": severity
         }
     
-    def generate_repair_guide(self, issue: str, vehicle_info: Dict) -> Dict:
+    def generate_repair_guide(self, issue: str, vehicle_info: Union[VehicleInfo, Dict]) -> Dict:
         """
         Generate a detailed repair guide for a specific issue.
         
         Args:
             issue: Description of the issue to fix
-            vehicle_info: Dictionary with vehicle information
+            vehicle_info: VehicleInfo or dictionary with vehicle information
             
         Returns:
             Dictionary with repair steps, tools needed, and difficulty
         """
-        # Generate the prompt for analysis
-        prompt = f"""You are an expert automotive repair technician. You're creating a detailed repair guide for a specific issue.
-
-Vehicle Information:
-- Year: {vehicle_info.get('year', 'Unknown')}
-- Make: {vehicle_info.get('make', 'Unknown')}
-- Model: {vehicle_info.get('model', 'Unknown')}
-- Mileage: {vehicle_info.get('mileage', 'Unknown')}
-
-Issue to Fix: {issue}
-
-Please provide a detailed repair guide including:
-1. A list of necessary tools and parts
-2. Step-by-step instructions
-3. Safety precautions
-4. Estimated time required
-5. Difficulty level (1-5, where 1 is easiest)
-6. Estimated cost range for parts
-
-Format your response as a JSON object with the following structure:
-{{
-  "repair_name": "Name of the repair procedure",
-  "description": "Overall description of the repair",
-  "tools_needed": ["Tool 1", "Tool 2", "..."],
-  "parts_needed": [
-    {{
-      "name": "Part name",
-      "estimated_cost": "$XX-$YY",
-      "part_number": "OEM or aftermarket part number (if available)"
-    }}
-  ],
-  "difficulty": 1-5,
-  "estimated_time": "X-Y hours",
-  "safety_precautions": ["Precaution 1", "Precaution 2", "..."],
-  "steps": ["Step 1", "Step 2", "..."],
-  "tips": ["Tip 1", "Tip 2", "..."]
-}}
-
-Provide only the JSON response, with no additional text before or after.
-"""
+        vehicle = VehicleInfo.from_dict(vehicle_info)
+        cache_key = _cache_key("repair", issue.strip().lower(), vehicle)
+        cached = _response_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Returning cached repair guide")
+            return cached
         
-        # Try with Anthropic first
-        if self.use_anthropic:
-            try:
-                repair_guide = self._repair_guide_with_anthropic(prompt)
-                if repair_guide:
-                    logger.info("Successfully generated repair guide with Anthropic")
-                    return repair_guide
-            except Exception as e:
-                logger.error(f"Error generating repair guide with Anthropic: {e}")
+        # Generate the prompt for analysis
+        prompt = _REPAIR_PROMPT_TEMPLATE.format_map({
+            "vehicle_block": vehicle.prompt_block,
+            "issue": issue
+        })
         
-        # Then try with OpenAI
-        if self.use_openai:
-            try:
-                repair_guide = self._repair_guide_with_openai(prompt)
-                if repair_guide:
-                    logger.info("Successfully generated repair guide with OpenAI")
-                    return repair_guide
-            except Exception as e:
-                logger.error(f"Error generating repair guide with OpenAI: {e}")
+        # Race the enabled AI providers, sharing the race with identical requests in flight
+        provider, repair_guide = self._shared_provider_result(
+            cache_key,
+            lambda: self._repair_guide_with_anthropic(prompt),
+            lambda: self._repair_guide_with_openai(prompt),
+            _REPAIR_GUIDE_DEFAULTS
+        )
+        if repair_guide:
+            logger.info(f"Successfully generated repair guide with {provider}")
+            return repair_guide
         
         # If all else fails, return a basic message
         logger.warning("Unable to generate repair guide. No AI services available.")
@@ -629,49 +2296,9 @@ Provide only the JSON response, with no additional text before or after.
         Returns:
             Repair guide as a dictionary, or None if failed
         """
-        try:
-            # Use the pre-initialized client
-            if not self.anthropic_client:
-                logger.error("Anthropic client not initialized")
-                return None
-            
-            client = self.anthropic_client
-            
-            # Call Claude to generate the repair guide
-            # the newest Anthropic model is "claude-3-5-sonnet-20241022" which was released October 22, 2024
-            response = client.messages.create(
-                model="claude-3-5-sonnet-20241022",
-                max_tokens=4000,
-                messages=[
-                    {"role": "user", "content": prompt}
-                ]
-            )
-            
-            # Extract the JSON response
-            if response.content and len(response.content) > 0:
-                content_block = response.content[0]
-                if hasattr(content_block, 'text'):
-                    response_text = content_block.text
-                    # Try to parse the JSON response
-                    try:
-                        return json.loads(response_text)
-                    except json.JSONDecodeError as e:
-                        logger.error(f"Error parsing Anthropic JSON response: {e}")
-                        # Try to extract just the JSON part
-                        import re
-                        json_match = re.search(r'({[\s\S]*})', response_text)
-                        if json_match:
-                            try:
-                                return json.loads(json_match.group(1))
-                            except json.JSONDecodeError:
-                                logger.error("Failed to parse extracted JSON from Anthropic response")
-            
-            logger.error("Failed to get valid response from Anthropic")
-            return None
-            
-        except Exception as e:
-            logger.error(f"Error using Anthropic for repair guide: {e}")
-            return None
+        return self._call_anthropic(
+            prompt, _REPAIR_SYSTEM_PROMPT, "repair guide", REPAIR_GUIDE_TOKENS, _REPAIR_RESPONSE_FORMAT
+        )
     
     def _repair_guide_with_openai(self, prompt: str) -> Optional[Dict]:
         """
@@ -683,37 +2310,135 @@ Provide only the JSON response, with no additional text before or after.
         Returns:
             Repair guide as a dictionary, or None if failed
         """
-        try:
-            # Use the pre-initialized client
-            if not self.openai_client:
-                logger.error("OpenAI client not initialized")
-                return None
+        return self._call_openai(
+            prompt, _REPAIR_SYSTEM_PROMPT, "repair guide", REPAIR_GUIDE_TOKENS, _REPAIR_RESPONSE_FORMAT
+        )
+
+    def analyze_prompt(self, prompt: str, system: Optional[str] = None) -> Tuple[Optional[str], Optional[Dict]]:
+        """
+        Send a free-form prompt that asks for a JSON response to the enabled AI providers.
+        
+        Responses are cached by the hash of the prompts together with the
+        provider that gave them, so a repeated prompt is answered without
+        calling a provider.
+        
+        Args:
+            prompt: The prompt, describing the JSON structure to respond with
+            system: Optional system prompt
             
-            client = self.openai_client
-            
-            # Call OpenAI to generate the repair guide
-            # the newest OpenAI model is "gpt-4o" which was released May 13, 2024
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are an expert automotive repair technician."},
-                    {"role": "user", "content": prompt}
-                ],
-                response_format={"type": "json_object"}
-            )
+        Returns:
+            Tuple of provider name and parsed response, or (None, None) if all failed
+        """
+        cache_key = _prompt_cache_key(prompt, system)
+        cached = _response_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Returning cached AI response")
+            return cached
+        
+        # Race the enabled AI providers, sharing the race with identical requests in flight
+        return self._shared_provider_result(
+            cache_key,
+            lambda: self._analyze_with_anthropic(prompt, system),
+            lambda: self._analyze_with_openai(prompt, system),
+            {},
+            cache_provider=True
+        )
+
+
+class DiagnosticSession:
+    """
+    AI diagnostics for a single vehicle over a diagnostic session.
+    
+    The vehicle is normalized and its prompt block rendered once, when the
+    session starts, and then reused by every analysis in the session.
+    """
+    
+    __slots__ = ('ai', 'vehicle')
+    
+    def __init__(self, ai: DiagnosticAI, vehicle: VehicleInfo):
+        """
+        Initialize the session.
+        
+        Args:
+            ai: DiagnosticAI used for the requests
+            vehicle: Vehicle being diagnosed
+        """
+        self.ai = ai
+        self.vehicle = vehicle
+    
+    def analyze_dtcs(self, dtcs: List[Dict]) -> Dict:
+        """
+        Analyze DTCs for the session's vehicle.
+        
+        Args:
+            dtcs: List of DTC dictionaries with code, type, and description
             
-            # Extract the JSON response
-            if response.choices and len(response.choices) > 0:
-                content = response.choices[0].message.content
-                if content:
-                    try:
-                        return json.loads(content)
-                    except json.JSONDecodeError as e:
-                        logger.error(f"Error parsing OpenAI JSON response: {e}")
+        Returns:
+            Dictionary with analysis, recommendations, and severity
+        """
+        return self.ai.analyze_dtcs(dtcs, self.vehicle)
+    
+    def analyze_dtcs_stream(self, dtcs: List[Dict]) -> Iterator[Tuple[str, Dict]]:
+        """
+        Analyze DTCs for the session's vehicle, yielding diagnoses as they complete.
+        
+        Args:
+            dtcs: List of DTC dictionaries with code, type, and description
             
-            logger.error("Failed to get valid response from OpenAI")
-            return None
+        Yields:
+            The same events as DiagnosticAI.analyze_dtcs_stream
+        """
+        return self.ai.analyze_dtcs_stream(dtcs, self.vehicle)
+    
+    def analyze_sensor_data(self, sensor_data: Union[SensorFrame, Dict]) -> Dict:
+        """
+        Analyze sensor data for the session's vehicle.
+        
+        Args:
+            sensor_data: SensorFrame or dictionary of sensor readings
             
-        except Exception as e:
-            logger.error(f"Error using OpenAI for repair guide: {e}")
-            return None
\ No newline at end of file
+        Returns:
+            Dictionary with analysis and recommendations
+        """
+        return self.ai.analyze_sensor_data(sensor_data, self.vehicle)
+    
+    def generate_repair_guide(self, issue: str) -> Dict:
+        """
+        Generate a repair guide for the session's vehicle.
+        
+        Args:
+            issue: Description of the issue to fix
+            
+        Returns:
+            Dictionary with repair steps, tools needed, and difficulty
+        """
+        return self.ai.generate_repair_guide(issue, self.vehicle)
+
+
+# DiagnosticAI instances shared by get_diagnostic_ai, keyed by the enabled providers
+_instances: Dict[Tuple[bool, bool], DiagnosticAI] = {}
+_instances_lock = threading.Lock()
+
+
+def get_diagnostic_ai(use_openai: bool = False, use_anthropic: bool = True) -> DiagnosticAI:
+    """
+    Get a DiagnosticAI shared by all callers that enable the same providers.
+    
+    DiagnosticAI holds no per-request state, so web request handlers can
+    share one instance instead of creating and configuring a new one for
+    every request.
+    
+    Args:
+        use_openai: Whether to use OpenAI for diagnostics
+        use_anthropic: Whether to use Anthropic for diagnostics
+        
+    Returns:
+        The shared DiagnosticAI instance
+    """
+    key = (use_openai, use_anthropic)
+    with _instances_lock:
+        ai = _instances.get(key)
+        if ai is None:
+            ai = DiagnosticAI(use_openai=use_openai, use_anthropic=use_anthropic)
+            _instances[key] = ai
+    return ai
\ No newline at end of file
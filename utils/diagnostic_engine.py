@@ -5,28 +5,123 @@ comprehensive vehicle diagnostics with AI enhancement.
 """
 
 import logging
+from operator import attrgetter
 from typing import Dict, List, Any, Optional
 import json
 
 # Import AI module
-from utils.diagnostic_ai import DiagnosticAI
+from utils.diagnostic_ai import get_diagnostic_ai
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Fields read from each DTC object, fetched in one call
+_DTC_FIELDS = attrgetter('code', 'description', 'type')
+
+# Static instructions and response structure for AI enhancement, built once and sent as
+# the system prompt; the per-request prompt only carries the vehicle and local results
+_ENHANCE_SYSTEM_PROMPT = """You are an expert automotive diagnostic technician analyzing OBD2 data. You enhance the diagnostic results you are given for a vehicle.
+
+Your task is to provide professional diagnostic insights and improve the repair recommendations.
+
+Please provide:
+1. Enhanced diagnoses with professional technical analysis
+2. Specific DIY repair procedures where appropriate
+3. Professional repair recommendations with accurate cost estimates
+4. Critical safety warnings if applicable
+
+Format your response as a JSON object with the following structure:
+{
+  "enhanced_diagnoses": [
+    {
+      "name": "Diagnosis name",
+      "description": "Professional technical description",
+      "confidence": 0.0-1.0,
+      "severity": "critical|high|medium|low|none"
+    }
+  ],
+  "enhanced_severity": "critical|high|medium|low|none",
+  "enhanced_diy_repairs": [
+    {
+      "issue_name": "Issue being repaired",
+      "repair_name": "Specific repair procedure name",
+      "description": "Detailed technical description",
+      "difficulty": 1-5,
+      "estimated_cost": "$XX-$YY",
+      "steps": ["Specific step 1", "Specific step 2", "..."]
+    }
+  ],
+  "enhanced_professional_repairs": [
+    {
+      "issue_name": "Issue being repaired",
+      "repair_name": "Professional repair procedure",
+      "description": "Technical description of repair",
+      "estimated_cost": "$XX-$YY"
+    }
+  ],
+  "enhanced_safety_warnings": [
+    {
+      "text": "Safety warning text",
+      "issue_name": "Related issue name"
+    }
+  ]
+}
+
+Provide only the JSON response with professional automotive expertise."""
+
+# Per-request part of the enhancement prompt, filled in with str.format_map
+_ENHANCE_PROMPT_TEMPLATE = """Please enhance the following diagnostic results for a vehicle:
+
+Vehicle: {year} {make} {model}
+Mileage: {mileage}
+
+Diagnostic Trouble Codes:
+{dtcs}
+
+Sensor Readings:
+{sensors}
+
+Current Analysis:
+{diagnoses}
+
+Current Severity: {severity}"""
+
 
 def analyze_obd2_data(dtcs, sensor_readings, vehicle_info):
     """
     Analyze OBD2 diagnostic data and return comprehensive results.
     
     Args:
-        dtcs: List of Diagnostic Trouble Codes
-        sensor_readings: List of sensor reading objects
+        dtcs: List of Diagnostic Trouble Code objects or dictionaries
+        sensor_readings: List of sensor reading objects or dictionaries
         vehicle_info: Dictionary containing vehicle information
         
     Returns:
         Dictionary with diagnosis, recommendations, and severity
     """
+    # Run the stream to the end, its last event holds the complete results
+    for _, results in analyze_obd2_data_stream(dtcs, sensor_readings, vehicle_info):
+        pass
+    return results
+
+
+def analyze_obd2_data_stream(dtcs, sensor_readings, vehicle_info):
+    """
+    Analyze OBD2 diagnostic data, yielding the local analysis before the AI enhancement.
+    
+    The diagnoses derived from the codes and sensor readings can be shown
+    right away, while the AI enhancement of the same results is still
+    being generated.
+    
+    Args:
+        dtcs: List of Diagnostic Trouble Code objects or dictionaries
+        sensor_readings: List of sensor reading objects or dictionaries
+        vehicle_info: Dictionary containing vehicle information
+        
+    Yields:
+        ("partial", results) with the local analysis when it will be
+        enhanced with AI, then ("final", results) with the complete results
+    """
     try:
         # Initialize the results dictionary
         results = {
@@ -38,40 +133,27 @@ def analyze_obd2_data(dtcs, sensor_readings, vehicle_info):
         }
         
         # Convert DTCs to analysis format
-        dtc_list = []
-        if dtcs:
-            for dtc in dtcs:
-                dtc_list.append({
-                    'code': dtc.code,
-                    'description': dtc.description,
-                    'type': dtc.type
-                })
+        dtc_list = [_dtc_record(dtc) for dtc in dtcs or ()]
         
         # Convert sensor readings to analysis format
-        sensor_data = {}
-        if sensor_readings:
-            for reading in sensor_readings:
-                sensor_data[reading.name] = {
-                    'value': reading.value,
-                    'unit': reading.unit,
-                    'pid': reading.pid
-                }
+        sensor_data = convert_sensor_readings(sensor_readings)
         
-        # Determine severity based on DTCs
-        severity = determine_severity(dtc_list)
+        # Determine severity based on DTCs, from a set of the codes that the
+        # specific code checks below reuse
+        dtc_codes = frozenset(dtc['code'] for dtc in dtc_list)
+        severity = _severity_for_codes(dtc_codes)
         results["severity"] = severity
         
-        # Generate diagnoses from DTCs
-        if dtc_list:
-            for dtc in dtc_list:
-                # Create diagnosis from each DTC
-                diagnosis = {
-                    "name": dtc['code'],
-                    "description": dtc['description'],
-                    "confidence": 0.9,  # DTCs have high confidence
-                    "severity": severity
-                }
-                results["diagnoses"].append(diagnosis)
+        # Generate a diagnosis from each DTC, they all share the overall severity
+        results["diagnoses"] = [
+            {
+                "name": dtc['code'],
+                "description": dtc['description'],
+                "confidence": 0.9,  # DTCs have high confidence
+                "severity": severity
+            }
+            for dtc in dtc_list
+        ]
         
         # Analyze sensor data for anomalies
         sensor_issues = analyze_sensor_anomalies(sensor_data)
@@ -113,9 +195,7 @@ def analyze_obd2_data(dtcs, sensor_readings, vehicle_info):
             })
         
         # Check for specific critical codes
-        critical_codes = ['P0301', 'P0302', 'P0303', 'P0304', 'P0305', 'P0306', 'P0307', 'P0308']
-        misfire_codes = [dtc['code'] for dtc in dtc_list if dtc['code'] in critical_codes]
-        if misfire_codes:
+        if not _MISFIRE_DTCS.isdisjoint(dtc_codes):
             results["safety_warnings"].append({
                 "text": "Engine misfire detected. Continued driving may cause catalytic converter damage. Reduce speed and seek immediate repair.",
                 "issue_name": "Engine Misfire"
@@ -131,16 +211,20 @@ def analyze_obd2_data(dtcs, sensor_readings, vehicle_info):
             })
             results["severity"] = "none"
         
-        # Use AI to enhance the diagnostic results
-        ai_enhanced_results = enhance_with_ai(results, dtc_list, sensor_data, vehicle_info)
-        if ai_enhanced_results:
-            results.update(ai_enhanced_results)
+        # Use AI to enhance the diagnostic results. A clean scan has nothing to
+        # enhance, so it skips the AI round trip
+        if dtc_list or sensor_issues:
+            # The enhancement replaces whole entries, so a shallow copy keeps the partial results intact
+            yield "partial", dict(results)
+            ai_enhanced_results = enhance_with_ai(results, dtc_list, sensor_data, vehicle_info)
+            if ai_enhanced_results:
+                results.update(ai_enhanced_results)
         
-        return results
+        yield "final", results
     
     except Exception as e:
         logger.error(f"Error analyzing OBD2 data: {str(e)}")
-        return {
+        yield "final", {
             "diagnoses": [{
                 "name": "Diagnostic Error",
                 "description": f"An error occurred during diagnostic analysis: {str(e)}",
@@ -157,6 +241,100 @@ def analyze_obd2_data(dtcs, sensor_readings, vehicle_info):
         }
 
 
+def _dtc_record(dtc):
+    """
+    Convert a DTC to the analysis format.
+    
+    Args:
+        dtc: DTC object, or dictionary such as those returned by the OBD2
+            connector, which is read without attribute access
+        
+    Returns:
+        Dictionary with code, description and type
+    """
+    if isinstance(dtc, dict):
+        return {
+            'code': dtc['code'],
+            'description': dtc.get('description', 'Unknown description'),
+            'type': dtc.get('type', 'stored')
+        }
+    code, description, dtc_type = _DTC_FIELDS(dtc)
+    return {'code': code, 'description': description, 'type': dtc_type}
+
+
+def convert_sensor_readings(sensor_readings):
+    """
+    Convert sensor readings to the analysis format.
+    
+    Accepts either a list of sensor reading objects or dictionaries, or a
+    column-oriented batch (a NumPy structured array or a dict of lists with
+    'name', 'value', 'unit' and 'pid' fields). Column-oriented batches are
+    read one field at a time instead of through per-object attribute access.
+    
+    Args:
+        sensor_readings: Sensor reading objects or dictionaries, or a column-oriented batch
+        
+    Returns:
+        Dictionary of sensor readings keyed by sensor name
+    """
+    sensor_data = {}
+    if sensor_readings is None:
+        return sensor_data
+    
+    if _is_columnar(sensor_readings):
+        columns = zip(sensor_readings['name'], sensor_readings['value'],
+                      sensor_readings['unit'], sensor_readings['pid'])
+        for name, value, unit, pid in columns:
+            sensor_data[str(name)] = {
+                'value': value,
+                'unit': str(unit),
+                'pid': str(pid)
+            }
+        return sensor_data
+    
+    for reading in sensor_readings:
+        if isinstance(reading, dict):
+            sensor_data[reading['name']] = {
+                'value': reading['value'],
+                'unit': reading.get('unit', ''),
+                'pid': reading.get('pid', '')
+            }
+        else:
+            sensor_data[reading.name] = {
+                'value': reading.value,
+                'unit': reading.unit,
+                'pid': reading.pid
+            }
+    return sensor_data
+
+
+def _is_columnar(sensor_readings):
+    """Check whether sensor readings are a column-oriented batch."""
+    dtype = getattr(sensor_readings, 'dtype', None)
+    if dtype is not None:
+        return dtype.names is not None
+    return isinstance(sensor_readings, dict) and 'name' in sensor_readings
+
+
+# Cylinder misfire codes
+_MISFIRE_DTCS = frozenset({'P0301', 'P0302', 'P0303', 'P0304', 'P0305', 'P0306', 'P0307', 'P0308'})
+
+# Critical codes that require immediate attention
+_CRITICAL_DTCS = _MISFIRE_DTCS | frozenset({
+    'P0200', 'P0201', 'P0202', 'P0203', 'P0204', 'P0205', 'P0206', 'P0207',  # Injector circuits
+    'P0340', 'P0341', 'P0342', 'P0343',  # Camshaft position sensor
+    'P0335', 'P0336', 'P0337', 'P0338',  # Crankshaft position sensor
+})
+
+# High severity codes
+_HIGH_DTCS = frozenset({
+    'P0100', 'P0101', 'P0102', 'P0103',  # MAF sensor
+    'P0110', 'P0111', 'P0112', 'P0113',  # Intake air temp
+    'P0170', 'P0171', 'P0172', 'P0173', 'P0174', 'P0175',  # Fuel trim
+    'P0300',  # Random misfire
+})
+
+
 def determine_severity(dtc_list):
     """
     Determine the overall severity based on DTC codes.
@@ -167,39 +345,91 @@ def determine_severity(dtc_list):
     Returns:
         Severity level string
     """
-    if not dtc_list:
-        return "none"
-    
-    # Critical codes that require immediate attention
-    critical_codes = [
-        'P0301', 'P0302', 'P0303', 'P0304', 'P0305', 'P0306', 'P0307', 'P0308',  # Misfires
-        'P0200', 'P0201', 'P0202', 'P0203', 'P0204', 'P0205', 'P0206', 'P0207',  # Injector circuits
-        'P0340', 'P0341', 'P0342', 'P0343',  # Camshaft position sensor
-        'P0335', 'P0336', 'P0337', 'P0338',  # Crankshaft position sensor
-    ]
-    
-    # High severity codes
-    high_codes = [
-        'P0100', 'P0101', 'P0102', 'P0103',  # MAF sensor
-        'P0110', 'P0111', 'P0112', 'P0113',  # Intake air temp
-        'P0170', 'P0171', 'P0172', 'P0173', 'P0174', 'P0175',  # Fuel trim
-        'P0300',  # Random misfire
-    ]
-    
-    # Check for critical codes
-    for dtc in dtc_list:
-        if dtc['code'] in critical_codes:
-            return "critical"
+    return _severity_for_codes(frozenset(dtc['code'] for dtc in dtc_list))
+
+
+def _severity_for_codes(dtc_codes):
+    """
+    Determine the overall severity from the set of DTC codes.
     
-    # Check for high severity codes
-    for dtc in dtc_list:
-        if dtc['code'] in high_codes:
-            return "high"
+    Args:
+        dtc_codes: Frozenset of DTC codes
+        
+    Returns:
+        Severity level string
+    """
+    if not dtc_codes:
+        return "none"
+    if not _CRITICAL_DTCS.isdisjoint(dtc_codes):
+        return "critical"
+    if not _HIGH_DTCS.isdisjoint(dtc_codes):
+        return "high"
     
     # Default to medium for any DTCs present
     return "medium"
 
 
+# Sensor anomaly rules, checked in order. Each rule reads the first of its sensors that
+# is present; a condition, when given, names the direction of the fault. Names and
+# descriptions are filled in with str.format
+_SENSOR_ANOMALY_RULES = (
+    {
+        "sensors": ('COOLANT_TEMP',),
+        "test": lambda temp: temp > 100,  # Over 100°C
+        "condition": None,
+        "name": "Engine Overheating",
+        "description": "Engine coolant temperature is {value}°C, which is above normal operating range",
+        "confidence": 0.8,
+        "severity": "high"
+    },
+    {
+        "sensors": ('COOLANT_TEMP',),
+        "test": lambda temp: temp < 70,  # Under 70°C when warm
+        "condition": None,
+        "name": "Engine Not Reaching Operating Temperature",
+        "description": "Engine coolant temperature is {value}°C, which may indicate thermostat issues",
+        "confidence": 0.6,
+        "severity": "medium"
+    },
+    {
+        "sensors": ('RPM',),
+        "test": lambda rpm: rpm > 1200,  # High idle
+        "condition": None,
+        "name": "High Idle RPM",
+        "description": "Engine is idling at {value} RPM, which is higher than normal (700-900 RPM)",
+        "confidence": 0.7,
+        "severity": "medium"
+    },
+    {
+        "sensors": ('RPM',),
+        "test": lambda rpm: 0 < rpm < 500,  # Very low idle
+        "condition": None,
+        "name": "Low Idle RPM",
+        "description": "Engine is idling at {value} RPM, which may cause stalling",
+        "confidence": 0.7,
+        "severity": "medium"
+    },
+    {
+        "sensors": ('SHORT_FUEL_TRIM_1',),
+        "test": lambda stft: abs(stft) > 10,  # More than 10% fuel trim
+        "condition": lambda stft: "lean" if stft > 0 else "rich",
+        "name": "Fuel System Running {condition}",
+        "description": "Short term fuel trim is {value}%, indicating the engine is running {condition}",
+        "confidence": 0.8,
+        "severity": "medium"
+    },
+    {
+        "sensors": ('O2_VOLTAGE', 'OXYGEN_SENSOR_1'),
+        "test": lambda o2_voltage: o2_voltage < 0.1 or o2_voltage > 0.9,  # Stuck lean or rich
+        "condition": lambda o2_voltage: "lean" if o2_voltage < 0.1 else "rich",
+        "name": "Oxygen Sensor Stuck {condition}",
+        "description": "Oxygen sensor voltage is {value}V, indicating it may be stuck {condition}",
+        "confidence": 0.7,
+        "severity": "medium"
+    }
+)
+
+
 def analyze_sensor_anomalies(sensor_data):
     """
     Analyze sensor readings for anomalies.
@@ -213,66 +443,22 @@ def analyze_sensor_anomalies(sensor_data):
     issues = []
     
     try:
-        # Check engine temperature
-        if 'COOLANT_TEMP' in sensor_data:
-            temp = sensor_data['COOLANT_TEMP']['value']
-            if temp > 100:  # Over 100°C
-                issues.append({
-                    "name": "Engine Overheating",
-                    "description": f"Engine coolant temperature is {temp}°C, which is above normal operating range",
-                    "confidence": 0.8,
-                    "severity": "high"
-                })
-            elif temp < 70:  # Under 70°C when warm
-                issues.append({
-                    "name": "Engine Not Reaching Operating Temperature",
-                    "description": f"Engine coolant temperature is {temp}°C, which may indicate thermostat issues",
-                    "confidence": 0.6,
-                    "severity": "medium"
-                })
-        
-        # Check RPM at idle
-        if 'RPM' in sensor_data:
-            rpm = sensor_data['RPM']['value']
-            if rpm > 1200:  # High idle
-                issues.append({
-                    "name": "High Idle RPM",
-                    "description": f"Engine is idling at {rpm} RPM, which is higher than normal (700-900 RPM)",
-                    "confidence": 0.7,
-                    "severity": "medium"
-                })
-            elif rpm < 500 and rpm > 0:  # Very low idle
-                issues.append({
-                    "name": "Low Idle RPM",
-                    "description": f"Engine is idling at {rpm} RPM, which may cause stalling",
-                    "confidence": 0.7,
-                    "severity": "medium"
-                })
-        
-        # Check fuel trims
-        if 'SHORT_FUEL_TRIM_1' in sensor_data:
-            stft = sensor_data['SHORT_FUEL_TRIM_1']['value']
-            if abs(stft) > 10:  # More than 10% fuel trim
-                trim_type = "lean" if stft > 0 else "rich"
-                issues.append({
-                    "name": f"Fuel System Running {trim_type.title()}",
-                    "description": f"Short term fuel trim is {stft}%, indicating the engine is running {trim_type}",
-                    "confidence": 0.8,
-                    "severity": "medium"
-                })
-        
-        # Check oxygen sensor voltage
-        if 'O2_VOLTAGE' in sensor_data or 'OXYGEN_SENSOR_1' in sensor_data:
-            o2_key = 'O2_VOLTAGE' if 'O2_VOLTAGE' in sensor_data else 'OXYGEN_SENSOR_1'
-            o2_voltage = sensor_data[o2_key]['value']
-            if o2_voltage < 0.1 or o2_voltage > 0.9:  # Stuck lean or rich
-                condition = "lean" if o2_voltage < 0.1 else "rich"
-                issues.append({
-                    "name": f"Oxygen Sensor Stuck {condition.title()}",
-                    "description": f"Oxygen sensor voltage is {o2_voltage}V, indicating it may be stuck {condition}",
-                    "confidence": 0.7,
-                    "severity": "medium"
-                })
+        # Check every rule in a single pass over the table
+        for rule in _SENSOR_ANOMALY_RULES:
+            key = next((key for key in rule["sensors"] if key in sensor_data), None)
+            if key is None:
+                continue
+            value = sensor_data[key]['value']
+            if not rule["test"](value):
+                continue
+            
+            condition = rule["condition"](value) if rule["condition"] else ""
+            issues.append({
+                "name": rule["name"].format(condition=condition.title()),
+                "description": rule["description"].format(value=value, condition=condition),
+                "confidence": rule["confidence"],
+                "severity": rule["severity"]
+            })
     
     except Exception as e:
         logger.error(f"Error analyzing sensor anomalies: {str(e)}")
@@ -294,96 +480,41 @@ def enhance_with_ai(results, dtc_list, sensor_data, vehicle_info):
         Enhanced results or None if AI is not available
     """
     try:
-        # Check if we have AI libraries available
-        ai = DiagnosticAI(use_openai=False, use_anthropic=True)
+        # Check if we have AI libraries available, using the shared instance so the
+        # provider clients are configured once and not on every diagnostic run
+        ai = get_diagnostic_ai(use_openai=True, use_anthropic=True)
         
-        if not ai.use_anthropic:
+        if not ai.use_anthropic and not ai.use_openai:
             logger.warning("No AI libraries available for diagnostic enhancement")
             return None
         
-        # Format the current results for the AI
-        dtcs_str = ""
-        for dtc in dtc_list:
-            dtcs_str += f"- {dtc['code']}: {dtc['description']} (Type: {dtc['type']})\n"
+        # Format the current results for the AI, joining each list once
+        dtcs_str = "".join(
+            f"- {dtc['code']}: {dtc['description']} (Type: {dtc['type']})\n" for dtc in dtc_list
+        )
+        sensor_str = "".join(
+            f"- {name}: {data['value']} {data['unit']}\n" for name, data in sensor_data.items()
+        )
+        diagnoses_str = "".join(
+            f"- {diagnosis['name']}: {diagnosis['description']}\n" for diagnosis in results["diagnoses"]
+        )
         
-        sensor_str = ""
-        for name, data in sensor_data.items():
-            sensor_str += f"- {name}: {data['value']} {data['unit']}\n"
-        
-        diagnoses_str = ""
-        for diagnosis in results["diagnoses"]:
-            diagnoses_str += f"- {diagnosis['name']}: {diagnosis['description']}\n"
-        
-        # Create the prompt for AI enhancement
-        prompt = f"""You are an expert automotive diagnostic technician analyzing OBD2 data.
-Please enhance the following diagnostic results for a vehicle:
-
-Vehicle: {vehicle_info.get('year', 'Unknown')} {vehicle_info.get('make', 'Unknown')} {vehicle_info.get('model', 'Unknown')}
-Mileage: {vehicle_info.get('mileage', 'Unknown')}
-
-Diagnostic Trouble Codes:
-{dtcs_str if dtcs_str else "No DTCs detected"}
-
-Sensor Readings:
-{sensor_str if sensor_str else "No sensor anomalies detected"}
-
-Current Analysis:
-{diagnoses_str}
-
-Current Severity: {results['severity']}
-
-Your task is to provide professional diagnostic insights and improve the repair recommendations.
-
-Please provide:
-1. Enhanced diagnoses with professional technical analysis
-2. Specific DIY repair procedures where appropriate
-3. Professional repair recommendations with accurate cost estimates
-4. Critical safety warnings if applicable
-
-Format your response as a JSON object with the following structure:
-{{
-  "enhanced_diagnoses": [
-    {{
-      "name": "Diagnosis name",
-      "description": "Professional technical description",
-      "confidence": 0.0-1.0,
-      "severity": "critical|high|medium|low|none"
-    }}
-  ],
-  "enhanced_severity": "critical|high|medium|low|none",
-  "enhanced_diy_repairs": [
-    {{
-      "issue_name": "Issue being repaired",
-      "repair_name": "Specific repair procedure name",
-      "description": "Detailed technical description",
-      "difficulty": 1-5,
-      "estimated_cost": "$XX-$YY",
-      "steps": ["Specific step 1", "Specific step 2", "..."]
-    }}
-  ],
-  "enhanced_professional_repairs": [
-    {{
-      "issue_name": "Issue being repaired", 
-      "repair_name": "Professional repair procedure",
-      "description": "Technical description of repair",
-      "estimated_cost": "$XX-$YY"
-    }}
-  ],
-  "enhanced_safety_warnings": [
-    {{
-      "text": "Safety warning text",
-      "issue_name": "Related issue name"
-    }}
-  ]
-}}
-
-Provide only the JSON response with professional automotive expertise.
-"""
+        # Only the vehicle and local results go in the prompt; the static instructions are sent as the system prompt
+        prompt = _ENHANCE_PROMPT_TEMPLATE.format_map({
+            "year": vehicle_info.get('year', 'Unknown'),
+            "make": vehicle_info.get('make', 'Unknown'),
+            "model": vehicle_info.get('model', 'Unknown'),
+            "mileage": vehicle_info.get('mileage', 'Unknown'),
+            "dtcs": dtcs_str if dtcs_str else "No DTCs detected",
+            "sensors": sensor_str if sensor_str else "No sensor anomalies detected",
+            "diagnoses": diagnoses_str,
+            "severity": results['severity']
+        })
         
-        # Get AI analysis
-        analysis = ai._analyze_with_anthropic(prompt)
+        # Get AI analysis from whichever enabled provider answers first
+        provider, analysis = ai.analyze_prompt(prompt, _ENHANCE_SYSTEM_PROMPT)
         if analysis:
-            logger.info("Successfully enhanced OBD2 diagnostics with AI")
+            logger.info(f"Successfully enhanced OBD2 diagnostics with {provider}")
             enhanced_results = {}
             
             # Update results with AI enhancements
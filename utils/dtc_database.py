@@ -20,6 +20,8 @@ class DTCDatabaseManager:
     def __init__(self):
         """Initialize the DTC database manager."""
         logger.info("Initializing DTC Database Manager")
+        # Reference DTCs found so far, keyed by upper-case code
+        self._dtc_info_cache: Dict[str, Dict[str, Any]] = {}
     
     def initialize_database(self) -> bool:
         """
@@ -36,6 +38,7 @@ class DTCDatabaseManager:
                 return True
             
             logger.info("Populating DTC database with standard codes")
+            self._dtc_info_cache.clear()
             
             # Get the comprehensive DTC data
             dtc_data = self._get_comprehensive_dtc_data()
@@ -68,16 +71,25 @@ class DTCDatabaseManager:
         """
         Get comprehensive information for a specific DTC code.
         
+        The reference table is static once populated, so codes that are
+        found are cached and repeated lookups skip the database query. Each
+        caller gets its own copy, so changing it does not change the cache.
+        
         Args:
             code: The DTC code (e.g., 'P0301')
             
         Returns:
             Dictionary with DTC information or None if not found
         """
+        code = code.upper()
+        cached = self._dtc_info_cache.get(code)
+        if cached is not None:
+            return dict(cached)
+        
         try:
-            dtc = DtcDatabase.query.filter_by(code=code.upper()).first()
+            dtc = DtcDatabase.query.filter_by(code=code).first()
             if dtc:
-                return {
+                dtc_info = {
                     'code': dtc.code,
                     'description': dtc.description,
                     'likely_causes': dtc.likely_causes,
@@ -85,6 +97,8 @@ class DTCDatabaseManager:
                     'severity': dtc.severity,
                     'notes': dtc.notes
                 }
+                self._dtc_info_cache[code] = dtc_info
+                return dict(dtc_info)
             return None
         except Exception as e:
             logger.error(f"Error getting DTC info for {code}: {e}")